@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+Compara el pipeline de predicciones con el parseo en los hilos de descarga
+y con el parseo en un pool de procesos (ver core.threadme.pipeline), sobre un corpus
+de xml localidad_{municipio}.xml ya descargados y simulando la latencia de la descarga.
+Muestra el tiempo total y el uso de cada núcleo de CPU (leído de /proc/stat)
+
+    python -m benchmarks.hybrid <directorio> [--threads N] [--processes N] [--latency S] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from munch import Munch
+
+from benchmarks.prediccion import read_corpus
+from core.prediccion import parse_prediccion, parse_prediccion_raw
+from core.threadme import pipeline
+
+
+def cpu_times() -> list:
+    """
+    Tiempos (ocupado, total) de cada núcleo según /proc/stat o None si no está disponible
+    """
+    if not os.path.isfile("/proc/stat"):
+        return None
+    rt = []
+    with open("/proc/stat", "r") as f:
+        for line in f:
+            if line.startswith("cpu") and line[3].isdigit():
+                vals = [int(v) for v in line.split()[1:]]
+                idle = vals[3] + (vals[4] if len(vals) > 4 else 0)
+                rt.append((sum(vals) - idle, sum(vals)))
+    return rt
+
+
+def usage(ini: list, fin: list) -> list:
+    """
+    Porcentaje de uso de cada núcleo entre dos lecturas de cpu_times
+    """
+    if ini is None or fin is None:
+        return None
+    rt = []
+    for (b0, t0), (b1, t1) in zip(ini, fin):
+        rt.append(100 * (b1 - b0) / (t1 - t0) if t1 > t0 else 0)
+    return rt
+
+
+def fetch(latency: float, corpus: list, i: int, parse: bool) -> Munch:
+    # Simula la descarga (espera de E/S que libera el GIL) y opcionalmente parsea en el hilo
+    time.sleep(latency)
+    name, content = corpus[i]
+    data = Munch(elaborado=None, dias=None, url=name, source=None, municipio=name,
+                 content=content, encoding="iso-8859-15")
+    if parse:
+        data = parse_prediccion_raw(data)
+    return data
+
+
+def parse(data: Munch) -> Munch:
+    return parse_prediccion_raw(data)
+
+
+def encode(data: Munch) -> int:
+    return len(data.dias)
+
+
+def run(corpus: list, arg, processes: int) -> tuple:
+    stages = [(lambda i: fetch(arg.latency, corpus, i, processes == 0), arg.threads)]
+    if processes > 0:
+        stages.append((parse, processes, True))
+    stages.append((encode, 1))
+    ini = cpu_times()
+    t = time.perf_counter()
+    count = sum(1 for _ in pipeline(range(len(corpus)), *stages))
+    t = time.perf_counter() - t
+    return t, count, usage(ini, cpu_times())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark del parseo de predicciones en hilos o en procesos")
+    parser.add_argument('corpus', help="Directorio con los xml de predicción")
+    parser.add_argument('--threads', type=int, default=30, help="Hilos de descarga")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Procesos de parseo")
+    parser.add_argument('--latency', type=float, default=0.05, help="Segundos que se simula cada descarga")
+    parser.add_argument('--repeat', type=int, default=3, help="Número de repeticiones")
+    arg = parser.parse_args()
+
+    corpus = read_corpus(arg.corpus)
+    if not corpus:
+        sys.exit("No se han encontrado xml en " + arg.corpus)
+    # Comprueba que el parseo en otro proceso da lo mismo
+    for name, content in corpus[:10]:
+        if parse(fetch(0, [(name, content)], 0, False)).dias != parse_prediccion(content)[1]:
+            sys.exit("DIFERENTE " + name)
+
+    print("xml: {}, hilos: {}, latencia: {}s".format(len(corpus), arg.threads, arg.latency))
+    for label, processes in (("hilos", 0), ("procesos ({})".format(arg.processes), arg.processes)):
+        best = None
+        for _ in range(arg.repeat):
+            r = run(corpus, arg, processes)
+            best = r if best is None or r[0] < best[0] else best
+        t, count, cores = best
+        print("{}: {:.3f}s ({:.0f} xml/s)".format(label, t, count / t))
+        if cores is not None:
+            print("    cpu media {:.0f}%, por núcleo: {}".format(
+                sum(cores) / len(cores), " ".join("{:.0f}%".format(c) for c in cores)))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Compara el parser lxml de predicciones con el parser BeautifulSoup original
+sobre un corpus de xml localidad_{municipio}.xml ya descargados
+(ficheros .xml o .xml.gz, o archivos municipios.xml.gz de core.archive como
+los guardados en raw/AEMET/PREDICCION)
+
+    python -m benchmarks.prediccion <directorio> [--repeat N]
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import time
+
+import bs4
+
+from core.archive import unpack
+from core.prediccion import parse_prediccion, parse_prediccion_bs4
+
+
+def read_corpus(path: str) -> list:
+    corpus = []
+    for root, _, files in os.walk(path):
+        for fl in sorted(files):
+            fl = os.path.join(root, fl)
+            if fl.endswith("municipios.xml.gz"):
+                with open(fl, "rb") as f:
+                    for name, content in sorted(unpack(f.read()).items()):
+                        corpus.append((fl + ":" + name, content.encode("iso-8859-15", errors="replace")))
+            elif fl.endswith(".xml.gz"):
+                with gzip.open(fl, "rb") as f:
+                    corpus.append((fl, f.read()))
+            elif fl.endswith(".xml"):
+                with open(fl, "rb") as f:
+                    corpus.append((fl, f.read()))
+    return corpus
+
+
+def run_bs4(content: bytes):
+    # Igual que Aemet.get_xml: BeautifulSoup sobre el texto decodificado
+    text = content.decode("iso-8859-15", errors="replace")
+    return parse_prediccion_bs4(bs4.BeautifulSoup(text, "lxml"))
+
+
+def bench(fnc, corpus: list, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _, content in corpus:
+            fnc(content)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark del parser de predicciones")
+    parser.add_argument('corpus', help="Directorio con los xml de predicción")
+    parser.add_argument('--repeat', type=int, default=3, help="Número de repeticiones")
+    arg = parser.parse_args()
+
+    corpus = read_corpus(arg.corpus)
+    if not corpus:
+        sys.exit("No se han encontrado xml en " + arg.corpus)
+
+    diff = 0
+    for fl, content in corpus:
+        if run_bs4(content) != parse_prediccion(content):
+            diff = diff + 1
+            print("DIFERENTE", fl)
+
+    t_bs4 = bench(run_bs4, corpus, arg.repeat)
+    t_lxml = bench(parse_prediccion, corpus, arg.repeat)
+    print("xml:       {}".format(len(corpus)))
+    print("distintos: {}".format(diff))
+    print("bs4:       {:.3f}s ({:.2f}ms/xml)".format(t_bs4, 1000 * t_bs4 / len(corpus)))
+    print("lxml:      {:.3f}s ({:.2f}ms/xml)".format(t_lxml, 1000 * t_lxml / len(corpus)))
+    print("speedup:   x{:.1f}".format(t_bs4 / t_lxml))
+    if diff:
+        sys.exit(1)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+Ejecuta el scraping contra un corpus grabado con AEMET_RECORD (ver core.replay),
+sin conexión ni límites de peticiones y guardando en un directorio temporal,
+para medir de manera repetible los cambios en parseo, hilos y subidas
+
+    AEMET_RECORD=corpus LOCAL_BUCKET=$(mktemp -d) python -m scripts.scrap --pre    # grabar (una vez)
+    python -m benchmarks.scrap corpus --pre [--repeat N]                           # reproducir
+
+Se graba contra un bucket vacío para que el corpus tenga todas las consultas que hará la reproducción
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from core.bucket import LocalBucket
+from scripts.scrap import AsyncScrap, Scrap
+
+
+def run(corpus: str, arg) -> tuple:
+    os.environ["AEMET_REPLAY"] = corpus
+    path = tempfile.mkdtemp(prefix="aemet-bench-")
+    try:
+        sc = (AsyncScrap if arg.asyncio else Scrap)(LocalBucket(path))
+        t = time.perf_counter()
+        if arg.dia:
+            sc.do_dia()
+        if arg.mes:
+            sc.do_mes()
+        if arg.pre:
+            sc.do_prediccion()
+        t = time.perf_counter() - t
+        return t, len(sc.bucket.uploaded), sc.api.metrics.to_dict()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark del scraping sobre un corpus grabado")
+    parser.add_argument('corpus', help="Directorio del corpus grabado con AEMET_RECORD")
+    parser.add_argument('--dia', action='store_true', help="Histórico diario")
+    parser.add_argument('--mes', action='store_true', help="Histórico mensual")
+    parser.add_argument('--pre', action='store_true', help="Predicción")
+    parser.add_argument('--asyncio', action='store_true', help="Usar AsyncScrap")
+    parser.add_argument('--repeat', type=int, default=3, help="Número de repeticiones")
+    arg = parser.parse_args()
+    if not (arg.dia or arg.mes or arg.pre):
+        sys.exit("No se ha pasado ningún parámetro")
+    logging.basicConfig(level=logging.WARNING)
+
+    best = None
+    for i in range(arg.repeat):
+        t, uploaded, metrics = run(arg.corpus, arg)
+        print("ejecución {}: {:.3f}s {} ficheros".format(i + 1, t, uploaded))
+        best = t if best is None else min(best, t)
+    for stage, s in sorted(metrics["stages"].items()):
+        print("{}: {} en {:.3f}s".format(stage, s["count"], s["seconds"]))
+    print("mejor: {:.3f}s".format(best))
@@ -1,63 +1,187 @@
 import logging
+import json
 import os
 import re
 import time
 from datetime import date, datetime
 from functools import lru_cache
+from threading import Lock, local
+from urllib.parse import urlparse
 
 import bs4
 import requests
+from requests.adapters import HTTPAdapter
 from requests.models import Response
 from munch import Munch
 
+from .cache import HttpCache
+from .cost import CostModel
+from .metacache import MetaCache
+from .metrics import Metrics
+from .normalize import normalize
+from .planner import Planner
+from .prediccion import parse_prediccion
 from .provincias import prov_to_cod
-from .util import readMunch, safe_number, sexa_to_dec, YEAR
+from .ratelimit import RateLimiter, get_retry_after
+from .replay import Corpus, RecordAdapter, ReplayAdapter
+from .threadme import pipeline
+from .util import iter_json_array, readMunch, safe_number, sexa_to_dec, YEAR
 
 re_status = re.compile(r"<h1>\s*HTTP\s*Status\s*(\d+)\s*(.*?)</h1>", re.IGNORECASE)
+re_elaborado = re.compile(r"<elaborado>\s*(.*?)\s*</elaborado>", re.IGNORECASE)
 
 logger = logging.getLogger(__name__)
 
 
-def get_txt(soup, slc):
-    n = soup.select_one(slc)
-    if n is None:
-        return None
-    n = n.get_text().strip()
-    if n == "":
-        return None
-    return n
-
-
 class Aemet:
     """
     Api AEMET
 
     Atributos:
         YEAR_ZERO: primer año del que se tienen datos
+        RATE: peticiones por minuto permitidas para cada tipo de endpoint
+            api: endpoints de la api (cuentan para la cuota de la api key)
+            datos: urls de datos devueltas por la api
+            xml: xml y html de www.aemet.es y del centro de descargas
+            (con varias api keys, AEMET_KEY=key1,key2..., cada una tiene su límite api:1, api:2...)
+        API_THREADS: hilos que consultan los endpoints de la api en iter_json
+        DATOS_THREADS: hilos que descargan las urls de datos en iter_json
+        DIA_MAX_YEARS: número máximo de años de una consulta del histórico diario
+        DIA_MAX_DAYS: número máximo de días de una consulta del histórico diario
+        MES_MAX_YEARS: número máximo de años de una consulta del histórico mensual
+        META_TTL: segundos durante los que son válidos los metadatos de la caché persistente
+        TIMEOUT: segundos máximos de espera de cada llamada http (conexión y lectura)
     """
     YEAR_ZERO = 1972
+    RATE = dict(
+        api=int(os.environ.get("RATE_API", 45)),
+        datos=int(os.environ.get("RATE_DATOS", 90)),
+        xml=int(os.environ.get("RATE_XML", 600))
+    )
+    API_THREADS = int(os.environ.get("API_THREADS", 4))
+    DATOS_THREADS = int(os.environ.get("DATOS_THREADS", 16))
+    DIA_MAX_YEARS = 5
+    DIA_MAX_DAYS = 5 * 365
+    MES_MAX_YEARS = 3
+    META_TTL = float(os.environ.get("META_CACHE_TTL", 7 * 24)) * 3600
+    TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 60))
 
-    def __init__(self, key: str = os.environ.get("AEMET_KEY"), sleep_time: int = int(os.environ.get("SLEEP_TIME", 60))):
+    def __init__(self, key: str = os.environ.get("AEMET_KEY"), sleep_time: int = int(os.environ.get("SLEEP_TIME", 60)),
+                 pool_size: int = int(os.environ.get("POOL_SIZE", 30)), rate: dict = None,
+                 cache: HttpCache = None, record: str = None, replay: str = None, meta: MetaCache = None,
+                 costs: CostModel = None):
+        """
+        :param key: api key
+        :param sleep_time: segundos que se bloquea un endpoint tras un error
+        :param pool_size: tamaño del pool de conexiones de cada host
+        :param rate: peticiones por minuto de cada tipo de endpoint (ver RATE)
+        :param cache: caché http de los endpoints xml
+        :param record: directorio donde grabar todas las respuestas obtenidas
+            (por defecto la variable de entorno AEMET_RECORD, ver core.replay). Sin caché http
+            ni caché de metadatos, para que todas las respuestas lleguen completas al corpus
+        :param replay: directorio de un corpus grabado con record desde el que servir
+            las respuestas sin conexión, sin límite de peticiones ni caché
+            (por defecto la variable de entorno AEMET_REPLAY)
+        :param meta: caché persistente de provincias, municipios y bases
+            (por defecto el fichero de la variable de entorno META_CACHE, si se define)
+        :param costs: modelo de costes en el que registrar lo que tarda cada consulta del histórico
+            y con el que ordenar las consultas (ver job_cost)
+        """
+        record = record or os.environ.get("AEMET_RECORD")
+        replay = replay or os.environ.get("AEMET_REPLAY")
+        if replay:
+            record = None
+            cache = None
+            rate = {k: None for k in Aemet.RATE}
+            key = key or "replay"
+        if record or replay:
+            cache = None
+            meta = None
         if key in (None, ""):
             logger.warning("No se ha facilitado api key, por lo tanto solo estarán disponibles los endpoints xml")
-        self.key = key
+        # Se admite un pool de api keys separadas por comas, cada una con su propia cuota
+        self.keys = [k.strip() for k in (key or "").split(",") if k.strip()]
+        self.key = self.keys[0] if self.keys else key
         self.now = datetime.now()
         self.sleep_time = sleep_time
         self.requests_verify = not(os.environ.get("AVOID_REQUEST_VERIFY") == "true")
         logger.info("requests_verify = " + str(self.requests_verify))
         self.url = readMunch("aemet.yml")
+        self.local = local()
+        self.metrics = Metrics()
         self.last_url = None
         self.last_response = None
         self.count_requests = 0
+        self.lock_count = Lock()
+        rate = {**Aemet.RATE, **(rate or {})}
+        for e in self.key_endpoints:
+            rate[e] = rate["api"]
+        self.limiter = RateLimiter(**rate)
+        self.pool_size = pool_size
+        self.cache = cache
+        self.corpus = Corpus(replay or record) if (replay or record) else None
+        self.replay = bool(replay)
+        if self.corpus is not None:
+            logger.info("%s: %s", "replay" if self.replay else "record", self.corpus.path)
+        if self.cache is None and self.corpus is None and os.environ.get("HTTP_CACHE"):
+            self.cache = HttpCache(
+                os.environ["HTTP_CACHE"],
+                max_size=int(os.environ.get("HTTP_CACHE_SIZE", 512)) * 1024 * 1024
+            )
+        self.meta = meta
+        if self.meta is None and self.corpus is None and os.environ.get("META_CACHE"):
+            self.meta = MetaCache(file=os.environ["META_CACHE"], ttl=Aemet.META_TTL)
+        self.costs = costs
+        self.sessions = {}
+        self.lock_sessions = Lock()
         if not self.requests_verify:
             import urllib3
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+    @property
+    def last_url(self) -> str:
+        """
+        Última url consultada por el hilo actual
+        """
+        return getattr(self.local, "last_url", None)
+
+    @last_url.setter
+    def last_url(self, value: str):
+        self.local.last_url = value
+
+    @property
+    def last_response(self) -> Response:
+        """
+        Última respuesta obtenida por el hilo actual
+        """
+        return getattr(self.local, "last_response", None)
+
+    @last_response.setter
+    def last_response(self, value: Response):
+        self.local.last_response = value
+
+    def _meta_cached(self, key: str, fnc):
+        """
+        Obtiene un metadato de la caché persistente (si hay) o, si no está o ha caducado,
+        lo calcula con fnc y lo guarda en ella
+        """
+        if self.meta is not None:
+            value = self.meta.get(key)
+            if value is not None:
+                return value
+        value = fnc()
+        if self.meta is not None and value:
+            self.meta.set(key, value)
+        return value
+
     @lru_cache(maxsize=None)
     def get_provincias(self, source: str = "html") -> tuple:
         """
         Obtiene el listado de provincias
         """
+        return tuple(self._meta_cached("provincias/" + source, lambda: list(self._get_provincias(source))))
+
+    def _get_provincias(self, source: str) -> tuple:
         if source == "html":
             j = self.get_xml(self.url.provincias.html)
             provincias = set(i.attrs.get("value") for i in j.select("#provincia_selector option"))
@@ -74,6 +198,11 @@ class Aemet:
         """
         Obtiene los municipios de una provincia
         """
+        muns = self._meta_cached("municipios/{}/{}".format(source, provincia),
+                                 lambda: self._get_municipios(provincia, source))
+        return None if muns is None else tuple(muns)
+
+    def _get_municipios(self, provincia: str, source: str) -> list:
         if source == "html":
             url = self.url.municipios.html.format(loc=int(provincia))
             r = self.get_xml(url)
@@ -93,7 +222,7 @@ class Aemet:
             raise Exception("Parámetro source incorrecto %s" % source)
         if len(muns) == 0:
             logger.critical("GET " + url + " > " + str(self.last_response.text))
-        return tuple(sorted(set(muns)))
+        return sorted(set(muns))
 
     @property
     @lru_cache(maxsize=None)
@@ -101,7 +230,12 @@ class Aemet:
         """
         Obtiene las bases meteorológicas y su información asociada
         """
+        return self._meta_cached("bases", self._get_bases)
+
+    def _get_bases(self) -> list:
         bases = self.get_json(self.url.estaciones)
+        if bases is None:
+            return None
         for b in bases:
             b["latitud"] = sexa_to_dec(b["latitud"])
             b["longitud"] = sexa_to_dec(b["longitud"])
@@ -109,29 +243,197 @@ class Aemet:
             b["altitud"] = safe_number(b.get("altitud"), label="altitud")
         return bases
 
+    @property
+    def key_endpoints(self) -> list:
+        """
+        Tipos de endpoint del limitador de cada api key del pool
+        (vacío si solo hay una, en cuyo caso se usa el endpoint api)
+        """
+        if len(self.keys) < 2:
+            return []
+        return ["api:{}".format(i + 1) for i in range(len(self.keys))]
+
+    def key_endpoint(self, url: str) -> str:
+        """
+        Devuelve el tipo de endpoint del limitador correspondiente a la api key de una url
+        """
+        for k, e in zip(self.keys, self.key_endpoints):
+            if k in url:
+                return e
+        return "api"
+
+    def pick_key(self) -> str:
+        """
+        Devuelve la api key del pool con más cuota disponible
+        """
+        endpoints = self.key_endpoints
+        if not endpoints:
+            return self.key
+        budgets = [self.limiter.bucket(e).budget() for e in endpoints]
+        return self.keys[budgets.index(max(budgets))]
+
     def addkey(self, url: str) -> str:
         """
-        Añade a una url la api key
+        Añade a una url la api key (la del pool con más cuota disponible)
         """
-        if self.key in url:
-            return url
-        url = url.replace("api_key=", "api_key=" + self.key)
-        if self.key in url:
+        for k in self.keys:
+            if k in url:
+                return url
+        key = self.pick_key()
+        url = url.replace("api_key=", "api_key=" + key)
+        if key in url:
             return url
         if "?" in url:
-            return url + "&api_key=" + self.key
-        return url + "?api_key=" + self.key
+            return url + "&api_key=" + key
+        return url + "?api_key=" + key
+
+    def _rekey(self, url: str, endpoint: str) -> tuple:
+        """
+        Cambia la api key de una url que se va a reintentar por la del pool con más cuota,
+        para no esperar a que se recupere la que ha fallado
+
+        :return: tupla (url, tipo de endpoint)
+        """
+        if endpoint not in self.key_endpoints:
+            return url, endpoint
+        url = url.replace(self.keys[self.key_endpoints.index(endpoint)], "")
+        url = self.addkey(url)
+        return url, self.key_endpoint(url)
+
+    def key_stats(self) -> dict:
+        """
+        Uso de cada api key del pool
+
+        :return: diccionario con clave el tipo de endpoint de la key y valor
+            un diccionario con requests, throttled, sleep_seconds, backoff_seconds y budget (fichas disponibles)
+        """
+        endpoints = self.metrics.to_dict()["endpoints"]
+        stats = {}
+        for e in self.key_endpoints:
+            m = endpoints.get(e, {})
+            stats[e] = dict(
+                requests=m.get("requests", 0),
+                throttled=m.get("throttled", 0),
+                sleep_seconds=m.get("sleep_seconds", 0),
+                backoff_seconds=m.get("backoff_seconds", 0),
+                budget=self.limiter.bucket(e).budget()
+            )
+        return stats
 
-    def sleep(self, log=None):
+    def _session(self, url: str) -> requests.Session:
         """
-        Realiza una parada y resetea el contador de requests
+        Devuelve la sesión asociada al host de una url, creándola si aún no existe.
+        Cada sesión mantiene un pool de conexiones keep-alive de tamaño pool_size
+        que puede ser compartido por varios hilos
+
+        :param url: dirección que se va a consultar
+        :return: requests.Session del host de la url
+        """
+        host = urlparse(url).netloc
+        with self.lock_sessions:
+            s = self.sessions.get(host)
+            if s is None:
+                s = requests.Session()
+                s.verify = self.requests_verify
+                if self.replay:
+                    adapter = ReplayAdapter(self.corpus)
+                elif self.corpus is not None:
+                    adapter = RecordAdapter(self.corpus, pool_connections=1, pool_maxsize=self.pool_size,
+                                            pool_block=True)
+                else:
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                self.sessions[host] = s
+            return s
+
+    def pool_stats(self) -> dict:
+        """
+        Obtiene estadísticas de los pools de conexiones abiertos
+
+        :return: diccionario con clave scheme://host:port y valor un diccionario con:
+            connections: conexiones abiertas desde la creación del pool
+            requests: peticiones realizadas a través del pool
+            idle: conexiones disponibles para ser reutilizadas
+            maxsize: tamaño máximo del pool
+        """
+        with self.lock_sessions:
+            sessions = list(self.sessions.values())
+        stats = {}
+        for s in sessions:
+            for adapter in set(s.adapters.values()):
+                if not hasattr(adapter, "poolmanager"):
+                    continue
+                pools = adapter.poolmanager.pools
+                for k in pools.keys():
+                    p = pools[k]
+                    if p is None:
+                        continue
+                    stats["{}://{}:{}".format(p.scheme, p.host, p.port)] = {
+                        "connections": p.num_connections,
+                        "requests": p.num_requests,
+                        "idle": p.pool.qsize() if p.pool is not None else 0,
+                        "maxsize": self.pool_size
+                    }
+        return stats
+
+    def close(self):
+        """
+        Cierra las sesiones y sus pools de conexiones
+        """
+        with self.lock_sessions:
+            for s in self.sessions.values():
+                s.close()
+            self.sessions = {}
+
+    def sleep(self, log=None, endpoint: str = "api", retry_after: float = None, throttled: bool = False) -> float:
         """
+        Parada tras un error. Si la Aemet indica que se ha superado la cuota (429 o Retry-After)
+        se bloquea el tipo de endpoint: solo esperarán los hilos que quieran consultarlo,
+        el resto seguirá trabajando. Cualquier otro error solo afecta a la consulta que ha fallado,
+        así que solo ha de esperar quien llama
+
+        :param log: motivo de la parada
+        :param endpoint: tipo de endpoint a bloquear (api, datos o xml)
+        :param retry_after: segundos a esperar (por defecto self.sleep_time)
+        :param throttled: indica que el error es por superar la cuota
+        :return: segundos que ha de esperar quien llama (0 si se ha bloqueado el endpoint)
+        """
+        seconds = self.sleep_time if retry_after is None else retry_after
         if log:
-            logger.info("request:{} sleep:{} ".format(self.count_requests, self.sleep_time) + log)
-        time.sleep(self.sleep_time)
-        self.count_requests = 0
+            logger.info("request:{} sleep:{} {} ".format(self.count_requests, seconds, endpoint) + log)
+        if throttled or retry_after is not None:
+            self.limiter.penalize(endpoint, seconds)
+            return 0
+        return seconds
 
-    def _get(self, url: str, url_debug: str = None, intentos: int = 4, count_requests: bool = True) -> Response:
+    def _retry(self, r, log_url: str, endpoint: str) -> float:
+        """
+        Comprueba si una respuesta indica que hay que reintentar la consulta,
+        en cuyo caso aplica la parada necesaria (ver sleep)
+
+        :param r: Response de la llamada GET
+        :param log_url: dirección a mostrar en el log
+        :param endpoint: tipo de endpoint consultado
+        :return: None si no hay que reintentar la consulta o los segundos que ha de esperar
+            quien llama antes de reintentarla
+        """
+        if r.status_code == 429:
+            self.metrics.throttled(endpoint)
+            return self.sleep("status:429 en {}".format(log_url), endpoint=endpoint, retry_after=get_retry_after(r),
+                              throttled=True)
+        m = re_status.search(r.text)
+        if m:
+            status, error = m.groups()
+            error = error.lstrip("-").lstrip()
+            if status == "429":
+                self.metrics.throttled(endpoint)
+            return self.sleep("status:{} en {} - {}".format(status, log_url, error), endpoint=endpoint,
+                              retry_after=get_retry_after(r), throttled=status == "429")
+        return None
+
+    def _get(self, url: str, url_debug: str = None, intentos: int = 4, count_requests: bool = True,
+             endpoint: str = "xml", stream: bool = False) -> Response:
         """
         Realiza una llamada GET a una url
 
@@ -139,81 +441,263 @@ class Aemet:
         :param url_debug: dirección a mostrar en el log
         :param intentos: número de intentos antes de reportar un error
         :param count_requests: indica si la consulta ha de incrementar el contador de requests o no
+        :param endpoint: tipo de endpoint (api, datos o xml) cuyo límite de peticiones se aplica
+        :param stream: indica que no se descargue el cuerpo de la respuesta (ni se use la caché)
         :return: Response de la llamada GET
+            (con from_cache = True si el servidor indica que la copia cacheada sigue siendo válida)
         """
         log_url = (url_debug or url)
         try:
             if count_requests:
-                self.count_requests = self.count_requests + 1
+                with self.lock_count:
+                    self.count_requests = self.count_requests + 1
                 self.last_url = log_url
                 self.last_response = None
-            r = requests.get(url, verify=self.requests_verify)
+            cache = self.cache if endpoint == "xml" and not stream else None
+            self.metrics.sleep(endpoint, self.limiter.acquire(endpoint))
+            t = time.perf_counter()
+            r = self._session(url).get(url, headers=cache.headers(url) if cache else None, stream=stream,
+                                     timeout=Aemet.TIMEOUT)
+            self.metrics.request(endpoint, time.perf_counter() - t, 0 if stream else len(r.content))
+            if cache and r.status_code == 304:
+                c = cache.get(url)
+                if c is not None:
+                    cache.hit()
+                    r = c
+                else:
+                    # Otro hilo ha expulsado la entrada de la caché tras pedir la consulta condicional
+                    cache.miss()
+                    self.metrics.sleep(endpoint, self.limiter.acquire(endpoint))
+                    t = time.perf_counter()
+                    r = self._session(url).get(url, timeout=Aemet.TIMEOUT)
+                    self.metrics.request(endpoint, time.perf_counter() - t, len(r.content))
+                    if r.status_code == 200:
+                        cache.put(url, r)
+            elif cache and r.status_code == 200:
+                cache.miss()
+                cache.put(url, r)
             if count_requests:
                 self.last_response = r
-            m = re_status.search(r.text)
-            if m and intentos > 0:
-                status, error = m.groups()
-                error = error.lstrip("-").lstrip()
-                self.sleep("status:{} en {} - {}".format(status, log_url, error))
-                return self._get(url, url_debug=url_debug, intentos=intentos - 1)
+            wait = self._retry(r, log_url, endpoint) if intentos > 0 and not stream else None
+            if wait is not None:
+                time.sleep(wait)
+                self.metrics.backoff(endpoint, wait)
+                self.metrics.retry(endpoint)
+                url, endpoint = self._rekey(url, endpoint)
+                return self._get(url, url_debug=url_debug, intentos=intentos - 1, count_requests=count_requests,
+                                 endpoint=endpoint)
             return r
         except Exception as e:
+            self.metrics.error(endpoint)
             if intentos > 0:
-                self.sleep("{} en {}".format(str(e), log_url))
-                return self._get(url, url_debug=url_debug, intentos=intentos - 1)
+                self.metrics.retry(endpoint)
+                wait = self.sleep("{} en {}".format(str(e), log_url), endpoint=endpoint)
+                time.sleep(wait)
+                self.metrics.backoff(endpoint, wait)
+                url, endpoint = self._rekey(url, endpoint)
+                return self._get(url, url_debug=url_debug, intentos=intentos - 1, count_requests=count_requests,
+                                 endpoint=endpoint, stream=stream)
             logger.critical("GET " + log_url + " > " + str(e), exc_info=True)
             return None
 
-    def _json(self, url: str, label: str):
+    def _read_json(self, r, url: str, label: str, endpoint: str, text: str = None) -> tuple:
+        """
+        Decodifica el json de una respuesta de la Aemet
+
+        :param r: Response de la llamada GET
+        :param url: dirección consultada
+        :param label: etiqueta que identifica el tipo de consulta (url_api o url_datos)
+        :param endpoint: tipo de endpoint consultado
+        :param text: texto de la respuesta si ya ha sido leído (por defecto r.text)
+        :return: tupla (dict o list, True si hay que reintentar la consulta)
+        """
+        if text is None:
+            text = r.text
+        try:
+            j = json.loads(text)
+        except Exception as e:
+            if "429 Too Many Requests" in text:
+                self.metrics.throttled(endpoint)
+                self.sleep("por error {}:429:Too Many Requests".format(label), endpoint=endpoint,
+                           retry_after=get_retry_after(r), throttled=True)
+                return None, True
+            logger.critical("GET " + url + " > " + str(text) + " > " + str(e), exc_info=True)
+            return None, False
+        if isinstance(j, dict) and j.get("estado") == 429:
+            # Too Many Requests
+            self.metrics.throttled(endpoint)
+            self.sleep("por error {}:429:Too Many Requests".format(label), endpoint=endpoint,
+                       retry_after=get_retry_after(r), throttled=True)
+            return None, True
+        return j, False
+
+    def _stream_json(self, r, url: str, label: str, endpoint: str):
+        """
+        Decodifica de manera incremental el json de una respuesta de la Aemet.
+        Si es un array se devuelve un generador de sus elementos, si no se decodifica
+        de golpe como en _read_json
+
+        :return: tupla (dict, list o generador, True si hay que reintentar la consulta)
+        """
+        encoding = r.encoding or "latin-1"
+
+        def count(it):
+            for c in it:
+                self.metrics.download(endpoint, len(c))
+                yield c
+
+        chunks = count(r.iter_content(chunk_size=64 * 1024))
+        first = b""
+        for first in chunks:
+            first = first.lstrip()
+            if first:
+                break
+        if first.startswith(b"["):
+            def gen():
+                try:
+                    for i in iter_json_array(chunks_with_first(), encoding=encoding):
+                        yield i
+                finally:
+                    r.close()
+
+            def chunks_with_first():
+                yield first
+                for c in chunks:
+                    yield c
+
+            return gen(), False
+        text = (first + b"".join(chunks)).decode(encoding, errors="replace")
+        r.close()
+        return self._read_json(r, url, label, endpoint, text=text)
+
+    def _json(self, url: str, label: str, stream: bool = False):
         """
         Obtiene los datos json de una consulta a la Aemet
 
         :param url: dirección a consultar
         :param label: etiqueta que identifica el tipo de consulta (url_api o url_datos)
-        :return: dict o list
+        :param stream: indica que los arrays se devuelvan como generadores que se decodifican
+            a medida que se descargan (solo para url_datos)
+        :return: dict, list o generador
         """
         if label == "url_datos":
-            r = self._get(self.addkey(url), url_debug=url, count_requests=False, intentos=0)
+            endpoint = "datos"
+            r = self._get(self.addkey(url), url_debug=url, count_requests=False, intentos=0, endpoint=endpoint,
+                          stream=stream)
         else:
-            r = self._get(self.addkey(url), url_debug=url)
+            stream = False
+            url_key = self.addkey(url)
+            # Con varias api keys cada una tiene su propio límite (api:1, api:2...)
+            endpoint = self.key_endpoint(url_key)
+            r = self._get(url_key, url_debug=url, endpoint=endpoint)
         if r is None:
             return None
-        try:
-            j = r.json()
-        except Exception as e:
-            if "429 Too Many Requests" in r.text:
-                self.sleep("por error {}:429:Too Many Requests".format(label))
-                return self._json(url, label)
-            logger.critical("GET " + url + " > " + str(r.text) + " > " + str(e), exc_info=True)
-            return None
-        if isinstance(j, dict) and j.get("estado") == 429:
-            # Too Many Requests
-            self.sleep("por error {}:429:Too Many Requests".format(label))
-            return self._json(url, label)
+        if stream:
+            j, retry = self._stream_json(r, url, label, endpoint)
+        else:
+            j, retry = self._read_json(r, url, label, endpoint)
+        if retry:
+            return self._json(url, label, stream=stream)
         return j
 
-    def get_json(self, url: str, no_data=None):
+    def _url_datos(self, url: str, j, no_data=None) -> tuple:
         """
-        Obtiene los datos json de un endpoint de la api de la Aemet
+        Extrae la url de datos de la respuesta de un endpoint de la api
 
         :param url: endpoint de la api Aemet
+        :param j: respuesta del endpoint
         :param no_data: Objeto a devolver en caso de no existir los datos
-        :return: dict o list
+        :return: tupla (url de datos, objeto a devolver si no hay url de datos)
         """
-        j = self._json(url, "url_api")
         if j is None:
-            return None
+            return None, None
         url_datos = j.get('datos')
         if url_datos is None:
             estado = j.get("estado")
             if estado == 404:
                 # No hay datos que satisfagan esos criterios
-                return no_data
+                return None, no_data
             logger.critical("GET " + url + " > " + str(j), exc_info=True)
-            return None
-        j = self._json(url_datos, "url_datos")
+            return None, None
+        return url_datos, None
+
+    def get_json(self, url: str, no_data=None, stream: bool = False):
+        """
+        Obtiene los datos json de un endpoint de la api de la Aemet
+
+        :param url: endpoint de la api Aemet
+        :param no_data: Objeto a devolver en caso de no existir los datos
+        :param stream: indica que si los datos son un array se devuelvan como un generador
+            que los va decodificando a medida que se descargan
+        :return: dict, list o generador
+        """
+        j = self._json(url, "url_api")
+        url_datos, j = self._url_datos(url, j, no_data=no_data)
+        if url_datos is None:
+            return j
+        j = self._json(url_datos, "url_datos", stream=stream)
         return j
 
+    def iter_json(self, jobs, parse=None, no_data=None, stream: bool = False, observe=None):
+        """
+        Obtiene los datos json de varios endpoints de la api de la Aemet en dos fases segmentadas:
+        API_THREADS hilos consultan los endpoints (que cuentan para la cuota) y van encolando
+        las urls de datos, que son descargadas por otros DATOS_THREADS hilos. Así las consultas
+        limitadas por la cuota no esperan a que terminen las descargas lentas
+
+        :param jobs: iterable de tuplas (clave, endpoint de la api Aemet)
+        :param parse: función (clave, datos) a aplicar en los hilos de descarga sobre los datos obtenidos
+        :param no_data: Objeto a devolver en caso de no existir los datos
+        :param stream: ver get_json, parse ha de consumir el generador
+        :param observe: función (clave, segundos) a la que se pasa lo que ha tardado la descarga
+            y el parseo de los datos de cada clave (la consulta al endpoint solo depende de la cuota)
+        :return: Generador de tuplas (clave, datos) en orden de finalización,
+            con datos = None si ha fallado cualquier fase (ninguna clave se queda sin respuesta)
+        """
+        if parse is None:
+            def parse(key, data):
+                return data
+
+        def do_api(key, url):
+            try:
+                j = self._json(url, "url_api")
+                url_datos, j = self._url_datos(url, j, no_data=no_data)
+            except Exception as e:
+                logger.critical("GET " + url + " > " + str(e), exc_info=True)
+                url_datos, j = None, None
+            return key, url_datos, j
+
+        def do_datos(key, url_datos, j):
+            t = time.perf_counter()
+            try:
+                if url_datos is not None:
+                    j = self._json(url_datos, "url_datos", stream=stream)
+                j = parse(key, j)
+            except Exception as e:
+                logger.critical("GET " + str(url_datos) + " > " + str(e), exc_info=True)
+                return key, None
+            if observe is not None and j is not None:
+                observe(key, time.perf_counter() - t)
+            return key, j
+
+        # Con un pool de api keys se reparte la cuota entre más hilos
+        api_threads = Aemet.API_THREADS * max(1, len(self.keys))
+        return pipeline(jobs, (do_api, api_threads), (do_datos, Aemet.DATOS_THREADS))
+
+    def _read_xml(self, url: str, text: str):
+        """
+        Parsea un xml de datos de la Aemet
+
+        :param url: dirección consultada
+        :param text: texto del response
+        :return: bs4.BeautifulSoup
+        """
+        try:
+            return bs4.BeautifulSoup(text, 'lxml')
+        except Exception as e:
+            logger.critical("GET " + url + " > " + str(text) + " > " + str(e), exc_info=True)
+            return None
+
     def get_xml(self, url: str, with_source: bool = False):
         """
         Obtiene un xml de datos de la Aemet
@@ -225,19 +709,45 @@ class Aemet:
         r = self._get(url)
         if r is None:
             return None
-        try:
-            soup = bs4.BeautifulSoup(r.text, 'lxml')
-        except Exception as e:
-            logger.critical("GET " + url + " > " + str(r.text) + " > " + str(e), exc_info=True)
+        soup = self._read_xml(url, r.text)
+        if soup is None:
             return None
         if with_source:
             return soup, r.text
         return soup
 
-    def get_prediccion(self, municipio: str) -> Munch:
+    def _parse_prediccion(self, municipio: str, url: str, content, source: str) -> Munch:
+        """
+        Extrae la predicción meteorológica de un municipio de su xml
+
+        :param municipio: municipio al que corresponde la predicción
+        :param url: url que retorna la predicción
+        :param content: xml (bytes o str) a parsear
+        :param source: xml original
+        :return: ver get_prediccion
+        """
+        try:
+            with self.metrics.timer("parse_prediccion"):
+                elaborado, arr = parse_prediccion(content)
+        except Exception as e:
+            logger.critical("GET " + url + " > " + str(source) + " > " + str(e), exc_info=True)
+            return None
+        return Munch(
+            elaborado=elaborado,
+            dias=arr,
+            url=url,
+            source=source,
+            municipio=municipio
+        )
+
+    def get_prediccion(self, municipio: str, parse: bool = True) -> Munch:
         """
         Obtiene la predicción meteorológica de un municipio
 
+        :param parse: si es False y no se puede reutilizar la predicción cacheada, no se parsea el xml:
+            se devuelve solo el contenido descargado (content y encoding, con source, elaborado y dias a None)
+            para parsearlo en otro proceso con core.prediccion.parse_prediccion_raw y guardarlo
+            en caché con set_prediccion
         :return: Objeto Munch con:
             elaborado: fecha de la elaboración de la predicción
             dias: listado de predicciones por día
@@ -247,62 +757,120 @@ class Aemet:
         """
         logger.info("PREDICCION " + municipio)
         url = self.url.localidad.format(municipio=municipio)
-        xml = self.get_xml(url, with_source=True)
-        if xml is None:
+        prev = self.cache.get_extra(url, "prediccion") if self.cache else None
+        r = self._get(url)
+        if r is None:
             return None
-        xml, source = xml
+        if prev is None and not parse:
+            return Munch(
+                elaborado=None,
+                dias=None,
+                url=url,
+                source=None,
+                municipio=municipio,
+                content=r.content,
+                encoding=r.encoding or r.apparent_encoding
+            )
+        source = r.text
+        if prev is not None:
+            elaborado = re_elaborado.search(source)
+            if elaborado and elaborado.group(1) == prev["elaborado"]:
+                # La predicción no ha cambiado desde que se parseó por última vez
+                self.cache.set_extra(url, "prediccion", prev)
+                return Munch(
+                    elaborado=prev["elaborado"],
+                    dias=prev["dias"],
+                    url=url,
+                    source=source,
+                    municipio=municipio
+                )
+        if not parse:
+            return Munch(
+                elaborado=None,
+                dias=None,
+                url=url,
+                source=source,
+                municipio=municipio,
+                content=r.content,
+                encoding=None
+            )
+        data = self._parse_prediccion(municipio, url, r.content, source)
+        if data is None:
+            return None
+        self.set_prediccion(data)
+        return data
+
+    def set_prediccion(self, data: Munch):
+        """
+        Guarda en la caché http la predicción ya parseada de un municipio
+        (para no volver a parsearla mientras no cambie su fecha de elaboración)
+        """
+        if self.cache:
+            self.cache.set_extra(data.url, "prediccion", dict(elaborado=data.elaborado, dias=data.dias))
+
+    def dia_fin(self, year: int, expand: bool = True) -> int:
+        """
+        Calcula el último año que se puede pedir en una consulta del histórico diario
+        que empieza en `year` sin superar el límite de la api
+
+        :param year: Año inicial de la consulta
+        :param expand: Indica que se obtenga todos los años posibles a partir del solicitado
+        """
+        fin = year
+        if expand:
+            fin = min(year + Aemet.DIA_MAX_YEARS - 1, YEAR)
+            a = date(year, 1, 1)
+            b = date(fin, 12, 31)
+            if fin > year:
+                bi = (a - b).days % 365
+                if bi > 1:
+                    fin = fin - 1
+        return fin
+
+    def _clean_dia(self, data, year: int, fin: int, expand: bool = True):
+        """
+        Reparte por años el histórico diario devuelto por la api a medida que se va leyendo
+        y luego lo normaliza por columnas
+
+        :param data: respuesta de la api (list o generador)
+        :param year: Año inicial de la consulta
+        :param fin: Año final de la consulta
+        :param expand: Indica si se ha consultado más de un año
+        :return: ver get_dia_estacion
+        """
+        if data is None or isinstance(data, (dict, str)):
+            return None
+        del_key = ("nombre", "provincia", "indicativo", "altitud")
         arr = []
-        elaborado = get_txt(xml, "elaborado")
-        for dia in xml.select("prediccion > dia"):
-            d = {
-                "fecha": dia.attrs["fecha"].strip()
-            }
-            for slc in (
-                    "prob_precipitacion",
-                    "cota_nieve_prov",
-                    "racha_max",
-                    "viento velocidad"
-            ):
-                vals = set()
-                for i, n in enumerate(dia.select(slc)):
-                    n = n.get_text()
-                    n = n.strip()
-                    n = safe_number(n, coma=False)
-                    if n is not None:
-                        vals.add(n)
-                        if i == 0:
-                            break
-                v = max(vals) if vals else None
-                d[slc.replace(" ", "_")] = v
-            for slc in (
-                    "temperatura maxima",
-                    "temperatura minima",
-                    "humedad_relativa maxima",
-                    "humedad_relativa minima",
-                    "estado_cielo",
-                    "sens_termica maxima",
-                    "sens_termica minima",
-                    "uv_max"
-            ):
-                v = get_txt(dia, slc)
-                d[slc.replace(" ", "_")] = safe_number(v, coma=False, nan=v)
-            d = {k: v for k, v in d.items() if v is not None}
-            arr.append(d)
-        return Munch(
-            elaborado=elaborado,
-            dias=arr,
-            url=url,
-            source=source,
-            municipio=municipio
-        )
+        expand_data = {}
+        for y in range(year, fin + 1):
+            expand_data[y] = []
+        try:
+            for d in data:
+                if expand:
+                    y = d["fecha"]
+                    y = int(y.split("-")[0])
+                    expand_data[y].append(d)
+                else:
+                    arr.append(d)
+        except Exception as e:
+            logger.critical("DIARIO [%s, %s] > %s", year, fin, str(e), exc_info=True)
+            return None
+        # Los campos de del_key y los vacíos se conservan (estos últimos con valor None)
+        with self.metrics.timer("normalize"):
+            if expand:
+                return {y: normalize(dias, coma=True, del_key=del_key, keep_empty=True) for y, dias in
+                        expand_data.items()}
+            return normalize(arr, coma=True, del_key=del_key, keep_empty=True)
 
-    def get_dia_estacion(self, id: str, year: int, expand: bool = True):
+    def get_dia_estacion(self, id: str, year: int, expand: bool = True, fin: int = None):
         """
         Obtiene el histórico diario de una estación y año
 
         :param id: Identificador de la estación
         :param year: Año que se desea consultar
         :param expand: Indica que se obtenga todos los años posibles a partir del solicitado
+        :param fin: Último año a obtener si expand = True (por defecto el último posible, ver dia_fin)
 
         :return:
             Si expand = False: histórico (lista de días) del año solicitado
@@ -312,61 +880,149 @@ class Aemet:
             return []
         if year > YEAR:
             return None
-        fin = year
-        if expand:
-            fin = min(year + 4, YEAR)
-            a = date(year, 1, 1)
-            b = date(fin, 12, 31)
-            if fin > year:
-                bi = (a - b).days % 365
-                if bi > 1:
-                    fin = fin - 1
-        del_key = ("nombre", "provincia", "indicativo", "altitud")
+        if fin is None or not expand:
+            fin = self.dia_fin(year, expand=expand)
         logger.info("DIARIO %s [%s, %s]", id, year, fin)
         url = self.url.estacion.diario.format(id=id, ini=year, fin=fin)
-        data = self.get_json(url, no_data=[])
+        data = self.get_json(url, no_data=[], stream=True)
+        return self._clean_dia(data, year, fin, expand=expand)
+
+    def iter_dia_estacion(self, jobs):
+        """
+        Obtiene el histórico diario de varias estaciones usando iter_json
+
+        :param jobs: iterable de Munch con id (estación), ini y fin (años inicial y final),
+            por ejemplo las consultas planificadas por dia_planner
+        :return: Generador de tuplas (consulta con su url,
+            diccionario con clave año y valor histórico del año clave)
+        """
+        def to_job(job):
+            logger.info("DIARIO %s [%s, %s]", job.id, job.ini, job.fin)
+            job = Munch(job, url=self.url.estacion.diario.format(id=job.id, ini=job.ini, fin=job.fin))
+            return job, job.url
+
+        def parse(job, data):
+            return self._clean_dia(data, job.ini, job.fin, expand=True)
+
+        jobs = (to_job(job) for job in jobs if Aemet.YEAR_ZERO <= job.ini <= job.fin <= YEAR)
+        return self.iter_json(jobs, parse=parse, no_data=[], stream=True, observe=self._observer("DIA"))
+
+    def iter_dia_fechas(self, jobs):
+        """
+        Obtiene el histórico diario de varias estaciones entre dos fechas usando iter_json
+        (para actualizar de manera incremental los años ya guardados)
+
+        :param jobs: iterable de Munch con id (estación), ini y fin (date inicial y final)
+        :return: Generador de tuplas (consulta con su url,
+            diccionario con clave año y valor histórico de ese año entre ini y fin)
+        """
+        def to_job(job):
+            logger.info("DIARIO %s [%s, %s]", job.id, job.ini, job.fin)
+            job = Munch(job, url=self.url.estacion.diario_fechas.format(id=job.id, ini=job.ini.isoformat(),
+                                                                        fin=job.fin.isoformat()))
+            return job, job.url
+
+        def parse(job, data):
+            return self._clean_dia(data, job.ini.year, job.fin.year, expand=True)
+
+        jobs = (to_job(job) for job in jobs if job.ini <= job.fin)
+        return self.iter_json(jobs, parse=parse, no_data=[], stream=True)
+
+    def _observer(self, kind: str):
+        """
+        Función para iter_json que registra en el modelo de costes lo que tarda cada consulta
+        planificada, por estación y año consultado
+        """
+        if self.costs is None:
+            return None
+
+        def observe(job, seconds):
+            self.costs.observe(kind, job.id, seconds, len(job.years))
+        return observe
+
+    def job_cost(self, kind: str):
+        """
+        Función que estima el coste de una consulta planificada del histórico
+        (por el número de años que consulta y lo que tardó su estación en ejecuciones anteriores)
+        """
+        if self.costs is None:
+            return lambda job: len(job.years)
+        return lambda job: self.costs.estimate(kind, job.id, len(job.years))
+
+    def dia_planner(self) -> Planner:
+        """
+        Planificador de consultas del histórico diario
+        """
+        return Planner(Aemet.DIA_MAX_YEARS, max_days=Aemet.DIA_MAX_DAYS, last_year=YEAR)
+
+    def _clean_mes(self, data, year: int = None, fin: int = None):
+        """
+        Normaliza el histórico mensual devuelto por la api
+
+        :param data: respuesta de la api
+        :param year: Año inicial de la consulta
+        :param fin: Año final de la consulta (si se indica se reparten los datos por años)
+        :return: ver get_mes_estacion
+        """
         if data is None or not isinstance(data, list):
             return None
+        del_key = ("nombre", "provincia", "indicativo", "altitud")
+        with self.metrics.timer("normalize"):
+            data = normalize(data, coma=False, del_key=del_key)
+        if fin is None:
+            return data
+        expand_data = {}
+        for y in range(year, fin + 1):
+            expand_data[y] = []
         for d in data:
-            for k, v in list(d.items()):
-                if k in del_key or v is None or (isinstance(v, str) and v.strip() == ""):
-                    del d[k]
-                d[k] = safe_number(v, coma=True, nan=v)
-        if expand:
-            expand_data = {}
-            for y in range(year, fin + 1):
-                expand_data[y] = []
-            for d in data:
-                y = d["fecha"]
-                y = int(y.split("-")[0])
-                expand_data[y].append(d)
-            return expand_data
-        return data
+            y = d["fecha"]
+            y = int(y.split("-")[0])
+            expand_data[y].append(d)
+        return expand_data
 
-    def get_mes_estacion(self, id: str, year: int) -> list:
+    def get_mes_estacion(self, id: str, year: int, fin: int = None):
         """
         Obtiene el histórico mensual de una estación y año
 
         :param id: Identificador de la estación
         :param year: Año que se desea consultar
+        :param fin: Último año que se desea consultar (como mucho MES_MAX_YEARS años tras year)
+
+        :return:
+            Si fin = None: histórico (lista de meses) del año solicitado
+            Si no: diccionario con clave año y valor histórico del año clave
         """
         if year < Aemet.YEAR_ZERO:
             return []
         if year > YEAR:
             return None
-        del_key = ("nombre", "provincia", "indicativo", "altitud")
-        logger.info("MENSUAL %s %s", id, year)
-        url = self.url.estacion.mensual.format(id=id, ini=year)
+        logger.info("MENSUAL %s [%s, %s]", id, year, fin or year)
+        url = self.url.estacion.mensual.format(id=id, ini=year, fin=min(fin or year, YEAR))
         data = self.get_json(url, no_data=[])
-        if data is None or not isinstance(data, list):
-            return None
-        for d in data:
-            # year, month = map(int, d["fecha"].split("-"))
-            for k, v in list(d.items()):
-                if k in del_key or v is None or (isinstance(v, str) and v.strip() == ""):
-                    del d[k]
-                else:
-                    d[k] = safe_number(v, coma=False, nan=v)
-            # d["year"] = year
-            # d["month"] = month
-        return data
+        return self._clean_mes(data, year, fin and min(fin, YEAR))
+
+    def iter_mes_estacion(self, jobs):
+        """
+        Obtiene el histórico mensual de varias estaciones usando iter_json
+
+        :param jobs: iterable de Munch con id (estación), ini y fin (años inicial y final),
+            por ejemplo las consultas planificadas por mes_planner
+        :return: Generador de tuplas (consulta con su url,
+            diccionario con clave año y valor histórico del año clave)
+        """
+        def to_job(job):
+            logger.info("MENSUAL %s [%s, %s]", job.id, job.ini, job.fin)
+            job = Munch(job, url=self.url.estacion.mensual.format(id=job.id, ini=job.ini, fin=job.fin))
+            return job, job.url
+
+        def parse(job, data):
+            return self._clean_mes(data, job.ini, job.fin)
+
+        jobs = (to_job(job) for job in jobs if Aemet.YEAR_ZERO <= job.ini <= job.fin <= YEAR)
+        return self.iter_json(jobs, parse=parse, no_data=[], observe=self._observer("MES"))
+
+    def mes_planner(self) -> Planner:
+        """
+        Planificador de consultas del histórico mensual
+        """
+        return Planner(Aemet.MES_MAX_YEARS, last_year=YEAR)
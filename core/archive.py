@@ -0,0 +1,120 @@
+import gzip
+import json
+import zlib
+from io import BytesIO
+
+from .bucket import Bucket
+
+# Metadato s3 con la posición del índice dentro del archivo
+INDEX_META = "index-offset"
+
+
+class ArchiveWriter:
+    def __init__(self):
+        """
+        Construye un archivo de documentos de texto (por ejemplo los xml de predicción de
+        todos los municipios de una provincia) como una concatenación de miembros gzip
+        independientes, de manera que cada documento puede descomprimirse por separado
+        leyendo solo sus bytes
+
+        El último miembro es el índice {nombre: [inicio, longitud]} escrito como comentario xml,
+        así que el fichero completo sigue siendo un .gz válido que gunzip descomprime entero
+        """
+        self.buffer = BytesIO()
+        self.index = {}
+
+    def add(self, name: str, content):
+        """
+        Añade un documento al archivo
+
+        :param name: nombre del documento (por ejemplo el municipio)
+        :param content: contenido del documento (str o bytes)
+        """
+        if isinstance(content, str):
+            content = content.encode()
+        start = self.buffer.tell()
+        self.buffer.write(gzip.compress(content))
+        self.index[name] = [start, self.buffer.tell() - start]
+
+    def close(self) -> tuple:
+        """
+        Escribe el índice al final del archivo
+
+        :return: tupla (contenido del archivo, posición del índice)
+        """
+        offset = self.buffer.tell()
+        index = "\n<!-- {} -->\n".format(json.dumps(self.index, sort_keys=True))
+        self.buffer.write(gzip.compress(index.encode()))
+        return self.buffer.getvalue(), offset
+
+
+def read_index(raw: bytes) -> dict:
+    """
+    Lee el índice de un archivo a partir de sus bytes desde la posición del índice
+    """
+    index = gzip.decompress(raw).decode().strip()
+    return json.loads(index[len("<!--"):-len("-->")])
+
+
+def unpack(content: bytes, offset: int = None) -> dict:
+    """
+    Extrae todos los documentos de un archivo completo
+
+    :param content: contenido del archivo
+    :param offset: posición del índice (si no se conoce, por ejemplo en una copia local
+        sin los metadatos s3, se localiza recorriendo los miembros gzip)
+    :return: diccionario {nombre: contenido}
+    """
+    if offset is None:
+        offset = 0
+        rest = content
+        while True:
+            d = zlib.decompressobj(wbits=31)
+            d.decompress(rest)
+            if not d.unused_data:
+                break
+            offset = offset + len(rest) - len(d.unused_data)
+            rest = d.unused_data
+    return {
+        name: gzip.decompress(content[start:start + size]).decode()
+        for name, (start, size) in read_index(content[offset:]).items()
+    }
+
+
+class ArchiveReader:
+    def __init__(self, bucket: Bucket, target: str):
+        """
+        Lee documentos sueltos de un archivo guardado en s3 con peticiones por rango,
+        sin descargar el archivo completo
+
+        :param bucket: bucket donde está el archivo
+        :param target: ruta del archivo
+        """
+        self.bucket = bucket
+        self.target = target
+        self._index = None
+
+    @property
+    def index(self) -> dict:
+        """
+        Índice del archivo (se descarga en el primer uso)
+        """
+        if self._index is None:
+            meta = self.bucket.head(self.target)
+            if meta is None:
+                raise Exception("No existe el archivo " + self.target)
+            self._index = read_index(self.bucket.get_range(self.target, int(meta[INDEX_META])))
+        return self._index
+
+    def names(self) -> list:
+        return sorted(self.index.keys())
+
+    def get(self, name: str) -> str:
+        """
+        Devuelve un documento del archivo o None si no está
+        """
+        pos = self.index.get(name)
+        if pos is None:
+            return None
+        start, size = pos
+        return gzip.decompress(self.bucket.get_range(self.target, start, start + size - 1)).decode()
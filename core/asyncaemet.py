@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from munch import Munch
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .aemet import Aemet
+from .replay import Corpus
+from .util import YEAR
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse:
+    def __init__(self, url: str, status_code: int, headers, content: bytes, encoding: str = None):
+        """
+        Respuesta ya descargada de una llamada GET asíncrona, con la misma interfaz
+        que requests.models.Response para los usos que hace Aemet
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or "utf-8"
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncAemet(Aemet):
+    """
+    Api AEMET con asyncio
+
+    Ofrece los mismos métodos de consulta que Aemet pero como corrutinas.
+    La concurrencia está limitada por un semáforo en vez de por el número de hilos.
+    Ha de usarse como contexto asíncrono (async with) para abrir y cerrar la sesión http.
+    Los metadatos (get_provincias, get_municipios y bases) no son asíncronos y han
+    de obtenerse con Aemet.
+    No mantiene last_url ni last_response: con todas las corrutinas en el mismo hilo
+    solo reflejarían la última petición de cualquiera de ellas.
+    """
+
+    def __init__(self, *args, concurrency: int = int(os.environ.get("ASYNC_CONCURRENCY", 200)), **kwargs):
+        """
+        :param concurrency: número máximo de peticiones en vuelo
+        """
+        super().__init__(*args, pool_size=concurrency, **kwargs)
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=None if self.requests_verify else False)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=Aemet.TIMEOUT))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+        self.session = None
+
+    def _replay(self, url: str) -> AsyncResponse:
+        """
+        Sirve una respuesta desde el corpus en modo replay (ver core.replay)
+        """
+        rec = self.corpus.load(url)
+        if rec is None:
+            logger.warning("replay: %s no está en el corpus", Corpus.clean_url(url))
+            rec = (404, {}, b"")
+        status_code, headers, content = rec
+        headers = CaseInsensitiveDict(headers)
+        return AsyncResponse(url, status_code, headers, content, get_encoding_from_headers(headers))
+
+    async def _get(self, url: str, url_debug: str = None, intentos: int = 4, count_requests: bool = True,
+                   endpoint: str = "xml") -> AsyncResponse:
+        """
+        Realiza una llamada GET asíncrona a una url (ver Aemet._get)
+        """
+        log_url = (url_debug or url)
+        try:
+            if count_requests:
+                with self.lock_count:
+                    self.count_requests = self.count_requests + 1
+            wait = self.limiter.reserve(endpoint)
+            if wait > 0:
+                self.metrics.sleep(endpoint, wait)
+                await asyncio.sleep(wait)
+            async with self.semaphore:
+                t = time.perf_counter()
+                if self.replay:
+                    r = self._replay(url)
+                else:
+                    async with self.session.get(url) as rs:
+                        r = AsyncResponse(url, rs.status, rs.headers, await rs.read(), rs.get_encoding())
+                    if self.corpus is not None:
+                        self.corpus.record(url, r.status_code, r.headers, r.content)
+                self.metrics.request(endpoint, time.perf_counter() - t, len(r.content))
+            wait = self._retry(r, log_url, endpoint) if intentos > 0 else None
+            if wait is not None:
+                await asyncio.sleep(wait)
+                self.metrics.backoff(endpoint, wait)
+                self.metrics.retry(endpoint)
+                url, endpoint = self._rekey(url, endpoint)
+                return await self._get(url, url_debug=url_debug, intentos=intentos - 1,
+                                       count_requests=count_requests, endpoint=endpoint)
+            return r
+        except Exception as e:
+            self.metrics.error(endpoint)
+            if intentos > 0:
+                self.metrics.retry(endpoint)
+                wait = self.sleep("{} en {}".format(str(e), log_url), endpoint=endpoint)
+                await asyncio.sleep(wait)
+                self.metrics.backoff(endpoint, wait)
+                url, endpoint = self._rekey(url, endpoint)
+                return await self._get(url, url_debug=url_debug, intentos=intentos - 1,
+                                       count_requests=count_requests, endpoint=endpoint)
+            logger.critical("GET " + log_url + " > " + str(e), exc_info=True)
+            return None
+
+    async def _json(self, url: str, label: str):
+        """
+        Obtiene los datos json de una consulta a la Aemet (ver Aemet._json)
+        """
+        if label == "url_datos":
+            endpoint = "datos"
+            r = await self._get(self.addkey(url), url_debug=url, count_requests=False, intentos=0,
+                                endpoint=endpoint)
+        else:
+            url_key = self.addkey(url)
+            endpoint = self.key_endpoint(url_key)
+            r = await self._get(url_key, url_debug=url, endpoint=endpoint)
+        if r is None:
+            return None
+        j, retry = self._read_json(r, url, label, endpoint)
+        if retry:
+            return await self._json(url, label)
+        return j
+
+    async def get_json(self, url: str, no_data=None):
+        """
+        Obtiene los datos json de un endpoint de la api de la Aemet (ver Aemet.get_json)
+        """
+        j = await self._json(url, "url_api")
+        url_datos, j = self._url_datos(url, j, no_data=no_data)
+        if url_datos is None:
+            return j
+        return await self._json(url_datos, "url_datos")
+
+    async def get_xml(self, url: str, with_source: bool = False):
+        """
+        Obtiene un xml de datos de la Aemet (ver Aemet.get_xml)
+        """
+        r = await self._get(url)
+        if r is None:
+            return None
+        soup = self._read_xml(url, r.text)
+        if soup is None:
+            return None
+        if with_source:
+            return soup, r.text
+        return soup
+
+    async def get_prediccion(self, municipio: str) -> Munch:
+        """
+        Obtiene la predicción meteorológica de un municipio (ver Aemet.get_prediccion)
+        """
+        logger.info("PREDICCION " + municipio)
+        url = self.url.localidad.format(municipio=municipio)
+        r = await self._get(url)
+        if r is None:
+            return None
+        return self._parse_prediccion(municipio, url, r.content, r.text)
+
+    async def get_dia_estacion(self, id: str, year: int, expand: bool = True, fin: int = None):
+        """
+        Obtiene el histórico diario de una estación y año (ver Aemet.get_dia_estacion)
+        """
+        if year < Aemet.YEAR_ZERO:
+            return []
+        if year > YEAR:
+            return None
+        if fin is None or not expand:
+            fin = self.dia_fin(year, expand=expand)
+        logger.info("DIARIO %s [%s, %s]", id, year, fin)
+        url = self.url.estacion.diario.format(id=id, ini=year, fin=fin)
+        data = await self.get_json(url, no_data=[])
+        return self._clean_dia(data, year, fin, expand=expand)
+
+    async def get_mes_estacion(self, id: str, year: int, fin: int = None):
+        """
+        Obtiene el histórico mensual de una estación y año (ver Aemet.get_mes_estacion)
+        """
+        if year < Aemet.YEAR_ZERO:
+            return []
+        if year > YEAR:
+            return None
+        logger.info("MENSUAL %s [%s, %s]", id, year, fin or year)
+        url = self.url.estacion.mensual.format(id=id, ini=year, fin=min(fin or year, YEAR))
+        data = await self.get_json(url, no_data=[])
+        return self._clean_mes(data, year, fin and min(fin, YEAR))
@@ -1,16 +1,105 @@
 import gzip
 import json
+import os
+import re
 from io import BytesIO
+from threading import Lock, local
 
 import boto3
 
+re_partition = re.compile(r"^([^/=]+)=([^/]+)/([^/=]+)=([^/.]+)")
+
 
 class Bucket:
     def __init__(self, name: str):
+        """
+        Bucket s3. Puede usarse desde varios hilos, cada uno con su propia sesión boto3
+
+        :param name: nombre del bucket
+        """
         self.name = name
-        self.bucket = boto3.resource('s3').Bucket(name)
+        self.local = local()
         self.new_files = []
         self.uploaded = []
+        self.indexes = {}
+        self.lock = Lock()
+
+    def _session(self) -> boto3.session.Session:
+        s = getattr(self.local, "session", None)
+        if s is None:
+            s = self.local.session = boto3.session.Session()
+        return s
+
+    @property
+    def bucket(self):
+        """
+        Recurso boto3 del bucket para el hilo actual
+        """
+        b = getattr(self.local, "bucket", None)
+        if b is None:
+            b = self.local.bucket = self._session().resource('s3').Bucket(self.name)
+        return b
+
+    @property
+    def client(self):
+        """
+        Cliente boto3 de s3 para el hilo actual
+        """
+        c = getattr(self.local, "client", None)
+        if c is None:
+            c = self.local.client = self._session().client('s3')
+        return c
+
+    def _put(self, target: str, fileobj, extra: dict):
+        """
+        Sube un fichero (primitiva de almacenamiento que redefine LocalBucket)
+
+        :param target: ruta del fichero
+        :param fileobj: objeto file-like con el contenido
+        :param extra: ContentType, ContentEncoding y Metadata del fichero
+        """
+        self.bucket.upload_fileobj(fileobj, target, extra)
+
+    def _get(self, target: str, rng: str = None) -> bytes:
+        """
+        Descarga un fichero, o el rango de bytes indicado (ver cabecera http Range)
+
+        :return: contenido o None si el fichero no existe
+        """
+        kwargs = dict(Bucket=self.name, Key=target)
+        if rng is not None:
+            kwargs["Range"] = rng
+        try:
+            obj = self.client.get_object(**kwargs)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return obj["Body"].read()
+
+    def _head(self, target: str) -> dict:
+        """
+        Devuelve los metadatos de un fichero o None si no existe
+        """
+        try:
+            obj = self.client.head_object(Bucket=self.name, Key=target)
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+        return obj.get("Metadata", {})
+
+    def _list(self, prefix: str):
+        """
+        Lista los objetos bajo un prefijo
+
+        :return: Generador de diccionarios con al menos la clave Key
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    def _delete(self, target: str):
+        self.client.delete_object(Bucket=self.name, Key=target)
 
     def up_gz(self, data, target: str, comment: str = None, overwrite: bool = True):
         """
@@ -65,21 +154,126 @@ class Bucket:
                 gz.write("/* {} */".format(comment).encode())
         compressed_fp.seek(0)
         self.uploaded.append(target)
-        r = self.bucket.upload_fileobj(
-            compressed_fp,
+        self._put(
             target,
+            compressed_fp,
             {'ContentType': content_type, 'ContentEncoding': 'gzip'}
         )
+        # Solo cuando la subida ha terminado bien, para que una fallida se vuelva a intentar
+        self._add_to_index(target)
         return True
 
+    def up_raw(self, content: bytes, target: str, content_type: str, metadata: dict = None):
+        """
+        Sube un fichero a s3 tal cual, sin comprimirlo (ni marcarlo como ContentEncoding gzip,
+        para que las peticiones por rango devuelvan los bytes almacenados)
+
+        :param content: contenido del fichero
+        :param target: ruta del fichero a crear
+        :param content_type: ContentType del fichero
+        :param metadata: metadatos s3 del fichero
+        """
+        if not self.exist(target):
+            self.new_files.append(target)
+        extra = {'ContentType': content_type}
+        if metadata:
+            extra['Metadata'] = {k: str(v) for k, v in metadata.items()}
+        self.uploaded.append(target)
+        self._put(target, BytesIO(content), extra)
+        self._add_to_index(target)
+        return True
+
+    def head(self, target: str) -> dict:
+        """
+        Devuelve los metadatos s3 de un fichero o None si no existe
+        """
+        return self._head(target)
+
+    def get_range(self, target: str, start: int, end: int = None) -> bytes:
+        """
+        Descarga los bytes [start, end] (ambos incluidos) de un fichero,
+        o desde start hasta el final si no se indica end
+        """
+        return self._get(target, "bytes={}-{}".format(start, "" if end is None else end))
+
+    def get_gz(self, target: str) -> str:
+        """
+        Descarga y descomprime un fichero subido con up_gz
+
+        :return: contenido del fichero o None si no existe
+        """
+        content = self._get(target)
+        if content is None:
+            return None
+        return gzip.decompress(content).decode()
+
+    def get_json_gz(self, target: str) -> list:
+        """
+        Descarga un fichero .json.gz subido con up_gz y devuelve sus registros
+        (descartando el comentario final)
+
+        :return: lista de registros o None si el fichero no existe
+        """
+        content = self.get_gz(target)
+        if content is None:
+            return None
+        data = []
+        for line in content.split("\n"):
+            line = line.strip()
+            if line in ("", "[]") or line.startswith("/*"):
+                continue
+            data.append(json.loads(line))
+        return data
+
     def exist(self, target: str) -> bool:
         """
         Comprueba si existe algún objeto bajo el prefix traget
         """
-        objs = list(self.bucket.objects.filter(Prefix=target))
-        if any([w.key == target for w in objs]):
-            return True
-        return False
+        with self.lock:
+            for prefix, (_, keys) in self.indexes.items():
+                if target.startswith(prefix):
+                    return target in keys
+        return any(o["Key"] == target for o in self._list(target))
+
+    def _add_to_index(self, key: str):
+        with self.lock:
+            for prefix, (partitions, keys) in self.indexes.items():
+                if not key.startswith(prefix):
+                    continue
+                keys.add(key)
+                m = re_partition.search(key[len(prefix):])
+                if m:
+                    partitions.setdefault(m.group(2), set()).add(m.group(4))
+
+    def index(self, prefix: str):
+        """
+        Crea un índice en memoria de los objetos bajo un prefijo con un único listado.
+        Las particiones prefix/k1=v1/k2=v2... quedan indexadas como {v1: {v2, ...}}.
+        El índice se actualiza con cada subida (up_gz) y se usa en exist()
+
+        :param prefix: prefijo a indexar (ha de terminar en /)
+        """
+        with self.lock:
+            if prefix in self.indexes:
+                return
+        keys = set(self.get_matching_s3_keys(prefix))
+        with self.lock:
+            if prefix in self.indexes:
+                return
+            self.indexes[prefix] = ({}, set())
+        for key in keys:
+            self._add_to_index(key)
+
+    def partitions(self, prefix: str, value: str) -> set:
+        """
+        Devuelve los valores de la segunda partición para un valor de la primera
+        a partir del índice del prefijo (que se crea si no existe)
+
+        Ejemplo: partitions("raw/AEMET/DIA/", "3195") -> {"1972", "1973", ...}
+        """
+        self.index(prefix)
+        with self.lock:
+            return set(self.indexes[prefix][0].get(value, ()))
 
     def get_matching_s3_objects(self, prefix: str = "", suffix: str = ""):
         """
@@ -90,28 +284,15 @@ class Bucket:
         :return: Generador con los objetos encontrados
         """
 
-        s3 = boto3.client("s3")
-        paginator = s3.get_paginator("list_objects_v2")
-
-        kwargs = {'Bucket': self.name}
-
         if isinstance(prefix, str):
             prefixes = (prefix,)
         else:
             prefixes = prefix
 
         for key_prefix in prefixes:
-            kwargs["Prefix"] = key_prefix
-            for page in paginator.paginate(**kwargs):
-                try:
-                    contents = page["Contents"]
-                except KeyError:
-                    break
-
-                for obj in contents:
-                    key = obj["Key"]
-                    if key.endswith(suffix):
-                        yield obj
+            for obj in self._list(key_prefix):
+                if obj["Key"].endswith(suffix):
+                    yield obj
 
     def get_matching_s3_keys(self, prefix: str = "", suffix: str = ""):
         """
@@ -149,5 +330,72 @@ class Bucket:
         """
         Borra todos los objetos bajo el prefijo pasado por parámetro
         """
-        for item in self.bucket.objects.filter(Prefix=prefix):
-            item.delete()
+        for obj in list(self._list(prefix)):
+            self._delete(obj["Key"])
+
+
+class LocalBucket(Bucket):
+    def __init__(self, path: str):
+        """
+        Bucket que guarda los ficheros en un directorio local en vez de en s3,
+        para ejecutar el scraping sin conexión (por ejemplo en modo replay, ver core.replay)
+
+        :param path: directorio raíz del bucket
+        """
+        super().__init__(path)
+        self.path = path
+
+    def _file(self, target: str) -> str:
+        return os.path.join(self.path, *target.split("/"))
+
+    def _meta(self, target: str) -> str:
+        return os.path.join(self.path, ".meta", *target.split("/")) + ".json"
+
+    def _put(self, target: str, fileobj, extra: dict):
+        for fl, content in (
+                (self._file(target), fileobj.read()),
+                (self._meta(target), json.dumps(extra.get("Metadata", {})).encode())
+        ):
+            os.makedirs(os.path.dirname(fl), exist_ok=True)
+            with open(fl, "wb") as f:
+                f.write(content)
+
+    def _get(self, target: str, rng: str = None) -> bytes:
+        fl = self._file(target)
+        if not os.path.isfile(fl):
+            return None
+        with open(fl, "rb") as f:
+            if rng is None:
+                return f.read()
+            start, end = rng.split("=", 1)[1].split("-")
+            f.seek(int(start))
+            if end == "":
+                return f.read()
+            return f.read(int(end) - int(start) + 1)
+
+    def _head(self, target: str) -> dict:
+        if not os.path.isfile(self._file(target)):
+            return None
+        try:
+            with open(self._meta(target), "r") as f:
+                return json.load(f)
+        except OSError:
+            return {}
+
+    def _list(self, prefix: str):
+        keys = []
+        for root, dirs, files in os.walk(self.path):
+            rel = os.path.relpath(root, self.path).replace(os.sep, "/")
+            if rel == ".meta" or rel.startswith(".meta/"):
+                continue
+            for fl in files:
+                key = fl if rel == "." else rel + "/" + fl
+                if key.startswith(prefix):
+                    keys.append(key)
+        for key in sorted(keys):
+            yield {"Key": key}
+
+    def _delete(self, target: str):
+        for fl in (self._file(target), self._meta(target)):
+            if os.path.isfile(fl):
+                os.remove(fl)
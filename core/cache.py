@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+
+class HttpCache:
+    def __init__(self, path: str, max_size: int = 512 * 1024 * 1024):
+        """
+        Caché persistente en disco de respuestas http con expulsión LRU
+
+        Por cada url se guarda el cuerpo de la respuesta (.body) y sus metadatos (.json):
+        ETag, Last-Modified, cabeceras y datos extra calculados a partir de la respuesta
+
+        :param path: directorio donde se guarda la caché
+        :param max_size: tamaño máximo (en bytes) de la caché
+        """
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index = OrderedDict()
+        os.makedirs(self.path, exist_ok=True)
+        files = []
+        for fl in os.listdir(self.path):
+            if fl.endswith(".body"):
+                fl = os.path.join(self.path, fl)
+                files.append((os.path.getmtime(fl), fl))
+        for _, fl in sorted(files):
+            key = os.path.basename(fl)[:-5]
+            self.index[key] = os.path.getsize(fl)
+        self.size = sum(self.index.values())
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def _file(self, key: str, ext: str) -> str:
+        return os.path.join(self.path, key + "." + ext)
+
+    def _write(self, file: str, content: bytes):
+        tmp = file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, file)
+
+    def _meta(self, key: str) -> dict:
+        try:
+            with open(self._file(key, "json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _evict(self):
+        while self.size > self.max_size and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.size = self.size - size
+            self.evictions = self.evictions + 1
+            for ext in ("body", "json"):
+                try:
+                    os.remove(self._file(key, ext))
+                except OSError:
+                    pass
+
+    def headers(self, url: str) -> dict:
+        """
+        Obtiene las cabeceras para hacer una petición condicional de una url cacheada
+        """
+        key = self._key(url)
+        with self.lock:
+            if key not in self.index:
+                return {}
+            meta = self._meta(key)
+        headers = {}
+        if meta is None:
+            return headers
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def get(self, url: str) -> Response:
+        """
+        Obtiene la respuesta cacheada de una url y la marca como recientemente usada
+
+        :return: Response con el atributo from_cache = True o None si no está cacheada
+        """
+        key = self._key(url)
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.index.move_to_end(key)
+            meta = self._meta(key)
+            try:
+                with open(self._file(key, "body"), "rb") as f:
+                    content = f.read()
+                os.utime(self._file(key, "body"))
+            except OSError:
+                return None
+        if meta is None:
+            return None
+        r = Response()
+        r.status_code = meta["status"]
+        r.url = meta["url"]
+        r.headers = CaseInsensitiveDict(meta["headers"])
+        r.encoding = meta["encoding"]
+        r._content = content
+        r.from_cache = True
+        return r
+
+    def put(self, url: str, r: Response):
+        """
+        Guarda la respuesta de una url
+        """
+        key = self._key(url)
+        meta = dict(
+            url=url,
+            status=r.status_code,
+            etag=r.headers.get("ETag"),
+            last_modified=r.headers.get("Last-Modified"),
+            headers={k: v for k, v in r.headers.items() if k.lower() in ("content-type", "etag", "last-modified")},
+            encoding=r.encoding,
+            extra={}
+        )
+        content = r.content
+        with self.lock:
+            self._write(self._file(key, "body"), content)
+            self._write(self._file(key, "json"), json.dumps(meta).encode())
+            self.size = self.size - self.index.pop(key, 0) + len(content)
+            self.index[key] = len(content)
+            self._evict()
+
+    def get_extra(self, url: str, name: str):
+        """
+        Obtiene un dato extra asociado a una url cacheada
+        """
+        key = self._key(url)
+        with self.lock:
+            if key not in self.index:
+                return None
+            meta = self._meta(key)
+        if meta is None:
+            return None
+        return meta["extra"].get(name)
+
+    def set_extra(self, url: str, name: str, value):
+        """
+        Asocia un dato extra (serializable a json) a una url cacheada
+        """
+        key = self._key(url)
+        with self.lock:
+            if key not in self.index:
+                return
+            meta = self._meta(key)
+            if meta is None:
+                return
+            meta["extra"][name] = value
+            self._write(self._file(key, "json"), json.dumps(meta).encode())
+
+    def hit(self):
+        with self.lock:
+            self.hits = self.hits + 1
+
+    def miss(self):
+        with self.lock:
+            self.misses = self.misses + 1
+
+    def stats(self) -> dict:
+        """
+        Obtiene estadísticas de uso de la caché
+        """
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self.index),
+                size=self.size
+            )
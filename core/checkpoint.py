@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+from threading import Lock
+
+from .bucket import Bucket
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    def __init__(self, bucket: Bucket = None, target: str = None, file: str = None, sync_every: int = 100):
+        """
+        Manifiesto de las unidades de trabajo ya terminadas, para que una ejecución
+        interrumpida pueda retomarse sin repetirlas
+
+        Cada unidad (por ejemplo DIA/3195/2020 o PREDICCION/28079) se guarda junto al hash
+        de los datos subidos. El manifiesto se guarda en un fichero local (en el que se añade
+        cada unidad nada más terminarse) y/o en s3, donde cada sync_every unidades se sube
+        una nueva parte {target}part-{n}.json.gz solo con las unidades terminadas desde la anterior
+
+        :param bucket: bucket donde guardar el manifiesto
+        :param target: directorio del manifiesto en el bucket (ha de terminar en /)
+        :param file: fichero local donde guardar el manifiesto
+        :param sync_every: número de unidades terminadas tras las que se sube una parte a s3
+        """
+        self.bucket = bucket
+        self.target = target
+        self.file = file
+        self.sync_every = sync_every
+        self.lock = Lock()
+        self.units = {}
+        self.pending = []
+        self.parts = 0
+        self.load()
+
+    def load(self):
+        """
+        Carga el manifiesto de s3 y del fichero local
+        """
+        rows = []
+        if self.bucket is not None and self.target is not None:
+            for key in sorted(self.bucket.get_matching_s3_keys(self.target, ".json.gz")):
+                rows.extend(self.bucket.get_json_gz(key) or [])
+                self.parts = self.parts + 1
+        if self.file is not None and os.path.isfile(self.file):
+            with open(self.file, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        rows.append(json.loads(line))
+        for r in rows:
+            self.units[r["unit"]] = r["hash"]
+        if self.units:
+            logger.info("checkpoint: %s unidades ya terminadas", len(self.units))
+
+    @staticmethod
+    def unit(*args) -> str:
+        return "/".join(str(a) for a in args)
+
+    @staticmethod
+    def hash(data) -> str:
+        """
+        Hash del contenido de una unidad de trabajo
+        """
+        if not isinstance(data, str):
+            data = json.dumps(data, sort_keys=True)
+        return hashlib.md5(data.encode()).hexdigest()
+
+    def is_done(self, *unit) -> bool:
+        with self.lock:
+            return Checkpoint.unit(*unit) in self.units
+
+    def done(self, unit: tuple, data):
+        """
+        Marca una unidad de trabajo como terminada
+
+        :param unit: identificador de la unidad
+        :param data: datos subidos para esa unidad
+        """
+        unit = Checkpoint.unit(*unit)
+        h = Checkpoint.hash(data)
+        with self.lock:
+            self.units[unit] = h
+            self.pending.append({"unit": unit, "hash": h})
+            if self.file is not None:
+                with open(self.file, "a") as f:
+                    f.write(json.dumps({"unit": unit, "hash": h}) + "\n")
+            sync = len(self.pending) >= self.sync_every
+        if sync:
+            self.save()
+
+    def save(self):
+        """
+        Sube a s3 una nueva parte del manifiesto con las unidades terminadas desde la última
+        """
+        if self.bucket is None or self.target is None:
+            return
+        with self.lock:
+            if not self.pending:
+                return
+            rows = self.pending
+            self.pending = []
+            target = "{}part-{:05d}.json".format(self.target, self.parts)
+            self.parts = self.parts + 1
+        self.bucket.up_gz(rows, target)
@@ -0,0 +1,68 @@
+import logging
+
+from .bucket import Bucket
+from .jsonstore import JsonStore
+
+logger = logging.getLogger(__name__)
+
+
+class CostModel(JsonStore):
+    def __init__(self, file: str = None, bucket: Bucket = None, target: str = None, alpha: float = 0.3):
+        """
+        Estimación del coste (segundos) de cada unidad de trabajo aprendida de ejecuciones anteriores,
+        para planificar primero los trabajos más largos (ver core.util.lpt)
+
+        Para cada tipo de trabajo (DIA, MES, PREDICCION...) y clave (estación, provincia...)
+        se guarda la media móvil exponencial de los segundos por unidad (años, municipios...).
+        Las claves sin historial usan la media de su tipo y, si tampoco hay, un segundo por unidad.
+        Todo se guarda en un único json {tipo: {clave: segundos por unidad}} en un fichero local o en s3
+
+        :param file: fichero local donde se guarda el modelo
+        :param bucket: bucket donde se guarda el modelo (si no se indica file)
+        :param target: ruta del modelo en el bucket (ha de terminar en .json)
+        :param alpha: peso de cada nueva observación en la media móvil
+        """
+        self.alpha = alpha
+        super().__init__(file=file, bucket=bucket, target=target, name="modelo de costes")
+
+    def load(self):
+        """
+        Carga el modelo del fichero local o de s3
+        """
+        super().load()
+        logger.info("modelo de costes: %s", {k: len(v) for k, v in self.data.items()})
+
+    def rate(self, kind: str, key: str) -> float:
+        """
+        Segundos por unidad estimados para una clave
+        """
+        with self.lock:
+            rates = self.data.get(kind, {})
+            r = rates.get(str(key))
+            if r is None and rates:
+                r = sum(rates.values()) / len(rates)
+        return 1 if r is None else r
+
+    def estimate(self, kind: str, key: str, size: float = 1) -> float:
+        """
+        Coste estimado (segundos) de un trabajo
+
+        :param kind: tipo de trabajo
+        :param key: clave del trabajo
+        :param size: unidades del trabajo
+        """
+        return self.rate(kind, key) * size
+
+    def observe(self, kind: str, key: str, seconds: float, size: float = 1):
+        """
+        Registra el coste real de un trabajo
+        """
+        if size <= 0:
+            return
+        r = seconds / size
+        key = str(key)
+        with self.lock:
+            rates = self.data.setdefault(kind, {})
+            old = rates.get(key)
+            rates[key] = r if old is None else old + self.alpha * (r - old)
+            self.dirty = True
@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+from threading import Lock
+
+from .bucket import Bucket
+
+logger = logging.getLogger(__name__)
+
+
+class JsonStore:
+    def __init__(self, file: str = None, bucket: Bucket = None, target: str = None, name: str = "json"):
+        """
+        Diccionario que se persiste entre ejecuciones como un único json en un fichero local o en s3
+        (base de MetaCache y CostModel). Las subclases modifican data con lock tomado y marcan dirty
+
+        :param file: fichero local donde se guarda el json
+        :param bucket: bucket donde se guarda el json (si no se indica file)
+        :param target: ruta del json en el bucket (ha de terminar en .json)
+        :param name: nombre con el que aparece en el log
+        """
+        self.file = file
+        self.bucket = bucket
+        self.target = target
+        self.name = name
+        self.lock = Lock()
+        self.data = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """
+        Carga el json del fichero local o de s3
+        """
+        content = None
+        if self.file is not None:
+            if os.path.isfile(self.file):
+                with open(self.file, "r") as f:
+                    content = f.read()
+        elif self.bucket is not None and self.target is not None:
+            content = self.bucket.get_gz(self.target + ".gz")
+        if content:
+            try:
+                self.data = json.loads(content)
+            except ValueError:
+                logger.warning("%s: json corrupto, se descarta", self.name)
+                self.data = {}
+
+    def save(self):
+        """
+        Guarda el json si se ha modificado
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            content = json.dumps(self.data, sort_keys=True)
+            self.dirty = False
+        if self.file is not None:
+            tmp = self.file + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(content)
+            os.replace(tmp, self.file)
+        elif self.bucket is not None and self.target is not None:
+            self.bucket.up_gz(content, self.target)
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+import time
+
+from .bucket import Bucket
+from .jsonstore import JsonStore
+
+logger = logging.getLogger(__name__)
+
+
+class MetaCache(JsonStore):
+    def __init__(self, file: str = None, bucket: Bucket = None, target: str = None, ttl: float = 7 * 24 * 3600):
+        """
+        Caché persistente con caducidad de los metadatos de la Aemet (provincias, municipios
+        y estaciones), que cambian muy poco y hacen falta antes de empezar el trabajo real
+
+        Todas las entradas se guardan en un único json {clave: {time, hash, value}}
+        en un fichero local o en s3. Al refrescar una entrada caducada se compara su hash
+        con el anterior para detectar (y registrar en changed) los cambios
+
+        :param file: fichero local donde se guarda la caché
+        :param bucket: bucket donde se guarda la caché (si no se indica file)
+        :param target: ruta de la caché en el bucket (ha de terminar en .json)
+        :param ttl: segundos que se considera válida una entrada
+        """
+        self.ttl = ttl
+        self.changed = set()
+        super().__init__(file=file, bucket=bucket, target=target, name="caché de metadatos")
+
+    def load(self):
+        """
+        Carga la caché del fichero local o de s3
+        """
+        super().load()
+        logger.info("caché de metadatos: %s entradas", len(self.data))
+
+    @staticmethod
+    def hash(value) -> str:
+        return hashlib.md5(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Devuelve el valor de una entrada o None si no existe o ha caducado
+        """
+        with self.lock:
+            e = self.data.get(key)
+            if e is None or time.time() - e["time"] > self.ttl:
+                return None
+            return e["value"]
+
+    def set(self, key: str, value) -> bool:
+        """
+        Guarda el valor de una entrada
+
+        :return: True si el valor ha cambiado respecto al que había guardado
+        """
+        h = MetaCache.hash(value)
+        with self.lock:
+            old = self.data.get(key)
+            changed = old is not None and old["hash"] != h
+            if changed:
+                self.changed.add(key)
+                logger.info("caché de metadatos: %s ha cambiado", key)
+            self.data[key] = dict(time=time.time(), hash=h, value=value)
+            self.dirty = True
+        return changed
@@ -0,0 +1,171 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Registro thread-safe de métricas de las consultas a la Aemet por tipo de endpoint
+
+    Atributos:
+        BUCKETS: límites (en segundos) del histograma de latencias
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    COUNTERS = (
+        ("requests", "Peticiones realizadas"),
+        ("errors", "Peticiones que han lanzado una excepción"),
+        ("retries", "Peticiones reintentadas"),
+        ("throttled", "Respuestas 429 Too Many Requests"),
+        ("bytes", "Bytes descargados"),
+        ("sleep_seconds", "Segundos esperando por el limitador de peticiones"),
+        ("backoff_seconds", "Segundos esperando antes de reintentar una petición fallida"),
+    )
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.time()
+        self.endpoints = {}
+        self.stages = {}
+        # Profiler (ver core.profiler) en el que marcar peticiones y esperas dentro de cada tarea
+        self.profiler = None
+
+    def _endpoint(self, endpoint: str) -> dict:
+        e = self.endpoints.get(endpoint)
+        if e is None:
+            e = {k: 0 for k, _ in Metrics.COUNTERS}
+            e["latency"] = [0] * (len(Metrics.BUCKETS) + 1)
+            e["latency_sum"] = 0
+            self.endpoints[endpoint] = e
+        return e
+
+    def _add(self, endpoint: str, key: str, value=1):
+        with self.lock:
+            e = self._endpoint(endpoint)
+            e[key] = e[key] + value
+
+    def request(self, endpoint: str, seconds: float, size: int = 0):
+        """
+        Registra una petición realizada
+
+        :param endpoint: tipo de endpoint
+        :param seconds: latencia de la petición
+        :param size: bytes descargados
+        """
+        if self.profiler is not None:
+            self.profiler.mark("GET " + endpoint, seconds)
+        i = 0
+        while i < len(Metrics.BUCKETS) and seconds > Metrics.BUCKETS[i]:
+            i = i + 1
+        with self.lock:
+            e = self._endpoint(endpoint)
+            e["requests"] = e["requests"] + 1
+            e["bytes"] = e["bytes"] + size
+            e["latency"][i] = e["latency"][i] + 1
+            e["latency_sum"] = e["latency_sum"] + seconds
+
+    def download(self, endpoint: str, size: int):
+        self._add(endpoint, "bytes", size)
+
+    def error(self, endpoint: str):
+        self._add(endpoint, "errors")
+
+    def retry(self, endpoint: str):
+        self._add(endpoint, "retries")
+
+    def throttled(self, endpoint: str):
+        self._add(endpoint, "throttled")
+
+    def sleep(self, endpoint: str, seconds: float):
+        if seconds > 0:
+            self._add(endpoint, "sleep_seconds", seconds)
+            if self.profiler is not None:
+                self.profiler.mark("sleep " + endpoint, seconds)
+
+    def backoff(self, endpoint: str, seconds: float):
+        if seconds > 0:
+            self._add(endpoint, "backoff_seconds", seconds)
+            if self.profiler is not None:
+                self.profiler.mark("backoff " + endpoint, seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Mide el tiempo dedicado a una etapa de procesado (parseo, normalización...)
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            t = time.perf_counter() - t
+            with self.lock:
+                s = self.stages.get(stage)
+                if s is None:
+                    s = self.stages[stage] = dict(count=0, seconds=0)
+                s["count"] = s["count"] + 1
+                s["seconds"] = s["seconds"] + t
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            endpoints = {}
+            for k, e in self.endpoints.items():
+                e = dict(e)
+                acc = 0
+                hist = {}
+                for le, n in zip(Metrics.BUCKETS + ("+Inf",), e["latency"]):
+                    acc = acc + n
+                    hist[str(le)] = acc
+                e["latency"] = hist
+                endpoints[k] = e
+            return dict(
+                elapsed=time.time() - self.start,
+                endpoints=endpoints,
+                stages={k: dict(v) for k, v in self.stages.items()}
+            )
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = "aemet") -> str:
+        """
+        Devuelve las métricas en el formato textfile de Prometheus
+        """
+        data = self.to_dict()
+        lines = []
+        for key, help in Metrics.COUNTERS:
+            name = "{}_{}_total".format(prefix, key)
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} counter".format(name))
+            for endpoint, e in sorted(data["endpoints"].items()):
+                lines.append('{}{{endpoint="{}"}} {}'.format(name, endpoint, e[key]))
+        name = prefix + "_request_seconds"
+        lines.append("# HELP {} Latencia de las peticiones".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for endpoint, e in sorted(data["endpoints"].items()):
+            for le, n in e["latency"].items():
+                lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(name, endpoint, le, n))
+            lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, endpoint, e["latency_sum"]))
+            lines.append('{}_count{{endpoint="{}"}} {}'.format(name, endpoint, e["requests"]))
+        name = prefix + "_stage_seconds_total"
+        lines.append("# HELP {} Segundos dedicados a cada etapa de procesado".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        for stage, s in sorted(data["stages"].items()):
+            lines.append('{}{{stage="{}"}} {}'.format(name, stage, s["seconds"]))
+        name = prefix + "_elapsed_seconds"
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("{} {}".format(name, data["elapsed"]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, json_file: str = None, prom_file: str = None):
+        """
+        Guarda las métricas en formato json y/o textfile de Prometheus
+        """
+        if json_file:
+            with open(json_file, "w") as f:
+                f.write(self.to_json())
+        if prom_file:
+            with open(prom_file, "w") as f:
+                f.write(self.to_prometheus())
@@ -0,0 +1,86 @@
+import numpy as np
+
+from .util import safe_number
+
+
+def _to_numbers(values: list, coma: bool = False) -> list:
+    """
+    Aplica safe_number(v, coma=coma, nan=v) a una columna de textos de una sola vez
+
+    Los textos que son claramente números se convierten en bloque con numpy,
+    el resto (fechas, horas, textos...) se convierten uno a uno con safe_number
+
+    :param values: lista de str
+    :param coma: ver safe_number
+    :return: lista con los valores convertidos
+    """
+    if not values:
+        return []
+    s = np.char.strip(np.array(values, dtype=str))
+    if coma:
+        s = np.char.replace(np.char.replace(s, ".", ""), ",", ".")
+    # Dígitos con, como mucho, un signo inicial y un punto decimal
+    unsigned = np.char.lstrip(s, "+-")
+    num = (np.char.str_len(s) - np.char.str_len(unsigned) <= 1) & np.char.isdigit(np.char.replace(unsigned, ".", "", 1))
+    rt = [None] * len(values)
+    idx = np.flatnonzero(num)
+    if len(idx):
+        try:
+            f = s[idx].astype(np.float64)
+        except ValueError:
+            idx = idx[:0]
+        else:
+            integer = (f == np.floor(f)) & (np.abs(f) < 2 ** 53)
+            for i, v, is_int in zip(idx.tolist(), f.tolist(), integer.tolist()):
+                rt[i] = int(v) if is_int else v
+    done = np.zeros(len(values), dtype=bool)
+    done[idx] = True
+    for i in np.flatnonzero(~done & (s != "")).tolist():
+        rt[i] = safe_number(values[i], coma=coma, nan=values[i])
+    return rt
+
+
+_MISSING = object()
+
+
+def normalize(data: list, coma: bool = False, del_key: tuple = tuple(), keep_empty: bool = False) -> list:
+    """
+    Normaliza por columnas una lista de registros de la api de la Aemet
+
+    Equivale a aplicar a cada valor safe_number(v, coma=coma, nan=v) pero separando
+    los registros en columnas y convirtiendo en bloque los valores distintos de cada una
+
+    :param data: lista de diccionarios
+    :param coma: indica que los números usan la coma como separador decimal
+    :param del_key: campos a eliminar
+    :param keep_empty: indica si se han de conservar (con valor None) los campos vacíos
+        y los campos de del_key (convertidos como el resto)
+    :return: lista de diccionarios normalizados
+    """
+    if not data:
+        return []
+    keys = dict.fromkeys(data[0])
+    first = data[0].keys()
+    complete = True
+    for d in data:
+        if d.keys() != first:
+            complete = False
+            keys.update(dict.fromkeys(d))
+    keys = [k for k in keys if keep_empty or k not in del_key]
+    if not keys:
+        return [dict() for _ in data]
+    cols = []
+    for k in keys:
+        if complete:
+            col = [d[k] for d in data]
+        else:
+            col = [d.get(k, _MISSING) for d in data]
+        uniq = list({v for v in col if isinstance(v, str)})
+        conv = dict(zip(uniq, _to_numbers(uniq, coma=coma)))
+        cols.append([conv.get(v, v) for v in col])
+    rt = [dict(zip(keys, row)) for row in zip(*cols)]
+    if not keep_empty:
+        return [{k: v for k, v in d.items() if v is not None and v is not _MISSING} for d in rt]
+    if not complete:
+        return [{k: v for k, v in d.items() if v is not _MISSING} for d in rt]
+    return rt
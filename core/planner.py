@@ -0,0 +1,115 @@
+import logging
+from datetime import date
+
+from munch import Munch
+
+from .util import lpt
+
+logger = logging.getLogger(__name__)
+
+
+class Planner:
+    def __init__(self, max_years: int, max_days: int = None, last_year: int = None):
+        """
+        Agrupa los años que faltan de cada estación en el menor número de consultas
+        que permiten los límites de un endpoint
+
+        :param max_years: número máximo de años que abarca una consulta
+        :param max_days: número máximo de días entre el inicio y el fin de una consulta
+        :param last_year: último año que se puede consultar
+        """
+        self.max_years = max_years
+        self.max_days = max_days
+        self.last_year = last_year
+
+    def fits(self, ini: int, fin: int) -> bool:
+        """
+        Comprueba si una consulta de los años [ini, fin] cumple los límites del endpoint
+        """
+        if fin - ini + 1 > self.max_years:
+            return False
+        if self.last_year is not None and fin > self.last_year:
+            return False
+        if self.max_days is not None and (date(fin, 12, 31) - date(ini, 1, 1)).days > self.max_days:
+            return False
+        return True
+
+    def plan_base(self, base: str, years) -> list:
+        """
+        Planifica las consultas de una estación. Cada consulta empieza en el primer año
+        pendiente y se alarga todo lo posible hasta el último año pendiente a su alcance
+
+        :param base: identificador de la estación
+        :param years: años pendientes
+        :return: lista de Munch(id, ini, fin, years) donde years son los años pendientes que cubre
+        """
+        jobs = []
+        years = sorted(years)
+        i = 0
+        while i < len(years):
+            ini = years[i]
+            j = i
+            while j + 1 < len(years) and self.fits(ini, years[j + 1]):
+                j = j + 1
+            jobs.append(Munch(id=base, ini=ini, fin=years[j], years=tuple(years[i:j + 1])))
+            i = j + 1
+        return jobs
+
+    def plan(self, missing: dict) -> list:
+        """
+        Planifica las consultas de varias estaciones
+
+        :param missing: diccionario con clave estación y valor años pendientes
+        :return: ver plan_base
+        """
+        jobs = []
+        for base, years in missing.items():
+            jobs.extend(self.plan_base(base, years))
+        return jobs
+
+    def split(self, job: Munch) -> list:
+        """
+        Divide una consulta fallida en dos mitades para reintentarlas
+
+        :return: lista con las nuevas consultas (vacía si la consulta era de un solo año)
+        """
+        if len(job.years) < 2:
+            return []
+        mid = len(job.years) // 2
+        jobs = []
+        for years in (job.years[:mid], job.years[mid:]):
+            jobs.extend(self.plan_base(job.id, years))
+        return jobs
+
+    def run(self, missing: dict, fetch, label: str = None, cost=None):
+        """
+        Ejecuta las consultas planificadas, dividiendo y reintentando las que fallen
+
+        :param missing: ver plan
+        :param fetch: función que recibe un iterable de consultas y devuelve un generador
+            de tuplas (consulta, datos) con datos = None si la consulta ha fallado
+        :param label: etiqueta para el log
+        :param cost: función que estima el coste de una consulta. Si se indica, las consultas
+            se lanzan de más a menos costosas para que las largas no se queden solas al final
+        :return: Generador de tuplas (consulta, datos) de las consultas con éxito
+        """
+        jobs = self.plan(missing)
+        if cost is not None:
+            jobs = lpt(jobs, cost)
+        logger.info("%s: %s años pendientes en %s consultas previstas", label, sum(len(j.years) for j in jobs),
+                    len(jobs))
+        count = 0
+        while jobs:
+            count = count + len(jobs)
+            failed = []
+            for job, data in fetch(jobs):
+                if data is None:
+                    failed.extend(self.split(job))
+                else:
+                    yield job, data
+            if failed:
+                logger.info("%s: reintentando %s consultas", label, len(failed))
+                if cost is not None:
+                    failed = lpt(failed, cost)
+            jobs = failed
+        logger.info("%s: %s consultas realizadas", label, count)
@@ -0,0 +1,162 @@
+import logging
+
+from lxml import etree
+
+from .util import safe_number
+
+logger = logging.getLogger(__name__)
+
+# Campos de los que se toma el primer valor numérico o, si el primero no lo es, el máximo
+MAX_FIELDS = (
+    ("prob_precipitacion", ".//prob_precipitacion"),
+    ("cota_nieve_prov", ".//cota_nieve_prov"),
+    ("racha_max", ".//racha_max"),
+    ("viento_velocidad", ".//viento//velocidad"),
+)
+# Campos de los que se toma el primer valor
+FIRST_FIELDS = (
+    ("temperatura_maxima", "(.//temperatura//maxima)[1]"),
+    ("temperatura_minima", "(.//temperatura//minima)[1]"),
+    ("humedad_relativa_maxima", "(.//humedad_relativa//maxima)[1]"),
+    ("humedad_relativa_minima", "(.//humedad_relativa//minima)[1]"),
+    ("estado_cielo", "(.//estado_cielo)[1]"),
+    ("sens_termica_maxima", "(.//sens_termica//maxima)[1]"),
+    ("sens_termica_minima", "(.//sens_termica//minima)[1]"),
+    ("uv_max", "(.//uv_max)[1]"),
+)
+
+_parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+_parser_str = etree.XMLParser(recover=True, resolve_entities=False, no_network=True, encoding="utf-8")
+_xp_text = etree.XPath("string()")
+_xp_elaborado = etree.XPath("(//elaborado)[1]")
+_xp_dias = etree.XPath("//prediccion/dia")
+_xp_max = tuple((k, etree.XPath(xp)) for k, xp in MAX_FIELDS)
+_xp_first = tuple((k, etree.XPath(xp)) for k, xp in FIRST_FIELDS)
+
+
+def _txt(nodes):
+    if not nodes:
+        return None
+    n = _xp_text(nodes[0]).strip()
+    if n == "":
+        return None
+    return n
+
+
+def parse_prediccion(content) -> tuple:
+    """
+    Extrae la predicción de un xml localidad_{municipio}.xml usando lxml y XPath precompilados
+
+    :param content: xml en bytes (respetando su declaración de encoding) o str
+    :return: tupla (fecha de elaboración, listado de predicciones por día)
+    """
+    if isinstance(content, str):
+        root = etree.fromstring(content.encode("utf-8"), _parser_str)
+    else:
+        root = etree.fromstring(content, _parser)
+    if root is None:
+        return None, []
+    arr = []
+    elaborado = _txt(_xp_elaborado(root))
+    for dia in _xp_dias(root):
+        d = {
+            "fecha": dia.get("fecha").strip()
+        }
+        for k, xp in _xp_max:
+            vals = set()
+            for i, n in enumerate(xp(dia)):
+                n = _xp_text(n).strip()
+                n = safe_number(n, coma=False)
+                if n is not None:
+                    vals.add(n)
+                    if i == 0:
+                        break
+            d[k] = max(vals) if vals else None
+        for k, xp in _xp_first:
+            v = _txt(xp(dia))
+            d[k] = safe_number(v, coma=False, nan=v)
+        d = {k: v for k, v in d.items() if v is not None}
+        arr.append(d)
+    return elaborado, arr
+
+
+def parse_prediccion_raw(data):
+    """
+    Completa una predicción obtenida con Aemet.get_prediccion(parse=False): decodifica el xml
+    (si no se hizo ya) y lo parsea. Está pensada para ejecutarse en un pool de procesos
+    (ver core.threadme.pipeline), así que solo recibe y devuelve datos que se pueden copiar entre procesos
+
+    :param data: Munch devuelto por Aemet.get_prediccion(parse=False)
+    :return: el mismo Munch con source, elaborado y dias rellenos (sin content ni encoding)
+        o None si el xml no se ha podido parsear
+    """
+    content = data.pop("content", None)
+    encoding = data.pop("encoding", None)
+    if data.dias is not None:
+        return data
+    try:
+        if data.source is None:
+            data.source = content.decode(encoding or "utf-8", errors="replace")
+        data.elaborado, data.dias = parse_prediccion(content)
+    except Exception as e:
+        logger.critical("GET " + data.url + " > " + str(data.source) + " > " + str(e), exc_info=True)
+        return None
+    return data
+
+
+def get_txt(soup, slc):
+    n = soup.select_one(slc)
+    if n is None:
+        return None
+    n = n.get_text().strip()
+    if n == "":
+        return None
+    return n
+
+
+def parse_prediccion_bs4(xml) -> tuple:
+    """
+    Extrae la predicción de un xml localidad_{municipio}.xml usando BeautifulSoup.
+    Es el parser original, se mantiene como referencia para benchmarks/prediccion.py
+
+    :param xml: bs4.BeautifulSoup del xml
+    :return: tupla (fecha de elaboración, listado de predicciones por día)
+    """
+    arr = []
+    elaborado = get_txt(xml, "elaborado")
+    for dia in xml.select("prediccion > dia"):
+        d = {
+            "fecha": dia.attrs["fecha"].strip()
+        }
+        for slc in (
+                "prob_precipitacion",
+                "cota_nieve_prov",
+                "racha_max",
+                "viento velocidad"
+        ):
+            vals = set()
+            for i, n in enumerate(dia.select(slc)):
+                n = n.get_text()
+                n = n.strip()
+                n = safe_number(n, coma=False)
+                if n is not None:
+                    vals.add(n)
+                    if i == 0:
+                        break
+            v = max(vals) if vals else None
+            d[slc.replace(" ", "_")] = v
+        for slc in (
+                "temperatura maxima",
+                "temperatura minima",
+                "humedad_relativa maxima",
+                "humedad_relativa minima",
+                "estado_cielo",
+                "sens_termica maxima",
+                "sens_termica minima",
+                "uv_max"
+        ):
+            v = get_txt(dia, slc)
+            d[slc.replace(" ", "_")] = safe_number(v, coma=False, nan=v)
+        d = {k: v for k, v in d.items() if v is not None}
+        arr.append(d)
+    return elaborado, arr
@@ -0,0 +1,177 @@
+import json
+import logging
+import time
+from threading import Lock, current_thread, get_ident
+
+logger = logging.getLogger(__name__)
+
+
+def _stats(values: list) -> dict:
+    if not values:
+        return dict(mean=0, p50=0, p95=0, max=0, sum=0)
+    values = sorted(values)
+    return dict(
+        mean=sum(values) / len(values),
+        p50=values[len(values) // 2],
+        p95=values[min(len(values) - 1, int(len(values) * 0.95))],
+        max=values[-1],
+        sum=sum(values)
+    )
+
+
+class Profiler:
+    def __init__(self, name: str = "ThreadMe", interval: float = None):
+        """
+        Perfil de ejecución de ThreadMe y pipeline: de cada tarea registra cuánto esperó en la cola
+        y cuánto tardó, y con ello calcula la utilización de los hilos de cada etapa, su tiempo ocioso
+        y la evolución del número de tareas terminadas por segundo
+
+        Además se pueden registrar marcas dentro de las tareas (por ejemplo las esperas del limitador
+        de peticiones o las propias peticiones, ver Metrics.profiler) para ver en qué se va el tiempo
+
+        :param name: nombre del perfil (para el log y la traza)
+        :param interval: segundos de cada intervalo de la evolución del throughput
+            (por defecto la vigésima parte de la duración total)
+        """
+        self.name = name
+        self.interval = interval
+        self.lock = Lock()
+        self.start = time.monotonic()
+        self.end = None
+        self.workers = {}
+        # (etapa, hilo, nombre del hilo, encolada, inicio, fin)
+        self.tasks = []
+        # (marca, hilo, nombre del hilo, inicio, fin)
+        self.marks = []
+
+    def stage(self, stage: str, workers: int) -> str:
+        """
+        Registra una etapa y su número de hilos
+
+        :return: nombre con el que se registran sus tareas: el de la etapa o, si ya había otra
+            con el mismo nombre (por ejemplo de otro pipeline con el mismo perfil), el nombre seguido de #n
+        """
+        with self.lock:
+            name = stage
+            n = 1
+            while name in self.workers:
+                n = n + 1
+                name = "{}#{}".format(stage, n)
+            self.workers[name] = workers
+        return name
+
+    def task(self, stage: str, queued: float, start: float, end: float):
+        """
+        Registra una tarea ejecutada por el hilo actual (tiempos de time.monotonic)
+        """
+        t = current_thread()
+        with self.lock:
+            self.tasks.append((stage, get_ident(), t.name, queued, start, end))
+
+    def mark(self, name: str, seconds: float):
+        """
+        Registra algo que acaba de terminar en el hilo actual y ha durado seconds
+        """
+        end = time.monotonic()
+        t = current_thread()
+        with self.lock:
+            self.marks.append((name, get_ident(), t.name, end - seconds, end))
+
+    def stop(self):
+        """
+        Fija el final del perfil (por defecto el momento en que se pide el resumen)
+        """
+        self.end = time.monotonic()
+
+    def summary(self) -> dict:
+        """
+        Resumen del perfil por etapa: tareas, espera en cola, ejecución, utilización media
+        de los hilos (y la del más y el menos ocupado), segundos ociosos y tareas terminadas
+        por segundo en cada intervalo
+        """
+        with self.lock:
+            tasks = list(self.tasks)
+            marks = list(self.marks)
+            workers = dict(self.workers)
+        end = self.end or time.monotonic()
+        elapsed = max(end - self.start, 1e-9)
+        interval = self.interval or max(elapsed / 20, 1e-3)
+        stages = {}
+        for stage in sorted(set(t[0] for t in tasks) | set(workers)):
+            st = [t for t in tasks if t[0] == stage]
+            busy = {}
+            for _, tid, _, _, ini, fin in st:
+                busy[tid] = busy.get(tid, 0) + fin - ini
+            n = workers.get(stage) or len(busy) or 1
+            total = sum(busy.values())
+            throughput = [0] * (int(elapsed / interval) + 1)
+            for t in st:
+                throughput[min(len(throughput) - 1, int((t[5] - self.start) / interval))] += 1
+            stages[stage] = dict(
+                tasks=len(st),
+                workers=n,
+                wait=_stats([t[4] - t[3] for t in st]),
+                exec=_stats([t[5] - t[4] for t in st]),
+                utilisation=total / (n * elapsed),
+                busiest=max(busy.values()) / elapsed if busy else 0,
+                idlest=min(busy.values()) / elapsed if len(busy) == n else 0,
+                idle_seconds=n * elapsed - total,
+                throughput=[round(c / interval, 2) for c in throughput]
+            )
+        by_mark = {}
+        for name, _, _, ini, fin in marks:
+            m = by_mark.setdefault(name, dict(count=0, seconds=0))
+            m["count"] = m["count"] + 1
+            m["seconds"] = m["seconds"] + fin - ini
+        return dict(name=self.name, elapsed=elapsed, interval=interval, stages=stages, marks=by_mark)
+
+    def log_summary(self):
+        """
+        Escribe el resumen en el log
+        """
+        s = self.summary()
+        logger.info("%s: %.1fs", s["name"], s["elapsed"])
+        for stage, st in s["stages"].items():
+            logger.info(
+                "%s %s: %s tareas, %s hilos, utilización %.0f%% (%.0f%%-%.0f%%), %.1fs ociosos, "
+                "espera en cola media %.3fs p95 %.3fs, ejecución media %.3fs p95 %.3fs",
+                s["name"], stage, st["tasks"], st["workers"], 100 * st["utilisation"], 100 * st["idlest"],
+                100 * st["busiest"], st["idle_seconds"], st["wait"]["mean"], st["wait"]["p95"],
+                st["exec"]["mean"], st["exec"]["p95"]
+            )
+            logger.info("%s %s: tareas/s cada %.1fs %s", s["name"], stage, s["interval"], st["throughput"])
+        for name, m in sorted(s["marks"].items()):
+            logger.info("%s %s: %s veces, %.1fs", s["name"], name, m["count"], m["seconds"])
+
+    def to_chrome_trace(self) -> dict:
+        """
+        Línea temporal en el formato Trace Event de Chrome (chrome://tracing o https://ui.perfetto.dev):
+        una fila por hilo con sus tareas y, dentro de ellas, sus marcas
+        """
+        with self.lock:
+            tasks = list(self.tasks)
+            marks = list(self.marks)
+
+        def us(t):
+            return round((t - self.start) * 1e6, 1)
+
+        events = []
+        names = {}
+        for stage, tid, tname, queued, ini, fin in tasks:
+            names[tid] = tname
+            events.append(dict(name=stage, cat="task", ph="X", pid=1, tid=tid, ts=us(ini), dur=us(fin) - us(ini),
+                               args=dict(wait=round(ini - queued, 6))))
+        for name, tid, tname, ini, fin in marks:
+            names[tid] = tname
+            events.append(dict(name=name, cat="mark", ph="X", pid=1, tid=tid, ts=us(ini), dur=us(fin) - us(ini)))
+        events.append(dict(name="process_name", ph="M", pid=1, args=dict(name=self.name)))
+        for tid, tname in names.items():
+            events.append(dict(name="thread_name", ph="M", pid=1, tid=tid, args=dict(name=tname)))
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def dump(self, trace_file: str):
+        """
+        Guarda la línea temporal en formato Trace Event de Chrome
+        """
+        with open(trace_file, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
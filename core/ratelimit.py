@@ -0,0 +1,142 @@
+import logging
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+def get_retry_after(r) -> float:
+    """
+    Obtiene los segundos de espera indicados en la cabecera Retry-After de una respuesta
+
+    :param r: Response de una llamada GET
+    :return: segundos a esperar o None si la cabecera no existe o no es válida
+    """
+    if r is None:
+        return None
+    v = r.headers.get("Retry-After")
+    if v in (None, ""):
+        return None
+    v = v.strip()
+    if v.isdigit():
+        return float(v)
+    try:
+        d = parsedate_to_datetime(v)
+    except (TypeError, ValueError):
+        return None
+    return max(0, d.timestamp() - time.time())
+
+
+class TokenBucket:
+    def __init__(self, rate: float = None, per: float = 60, burst: float = None):
+        """
+        Cubo de fichas thread-safe
+
+        :param rate: número de peticiones permitidas cada `per` segundos (None = sin límite)
+        :param per: periodo en segundos al que se refiere `rate`
+        :param burst: número máximo de peticiones que se pueden hacer de golpe (por defecto 1, como mucho rate / 2).
+            Las fichas se reponen a (rate - burst) / per por segundo, de manera que en ningún
+            periodo de `per` segundos (ni al arrancar ni tras un rato parado) se superan `rate` peticiones
+        """
+        self.rate = rate
+        self.capacity = min(burst or 1, rate / 2) if rate else 0
+        self.fill = ((rate - self.capacity) / per) if rate else 0
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0
+        self.lock = Lock()
+
+    def _refill(self, now: float):
+        if self.fill:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.fill)
+        self.stamp = now
+
+    def reserve(self) -> float:
+        """
+        Reserva una ficha sin bloquear
+
+        :return: segundos que hay que esperar antes de poder usar la ficha reservada
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0, self.blocked_until - now)
+            if not self.fill:
+                return wait
+            self.tokens = self.tokens - 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.fill)
+            return wait
+
+    def acquire(self) -> float:
+        """
+        Reserva una ficha y bloquea el hilo llamante hasta que pueda usarse
+
+        :return: segundos que se ha esperado
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def budget(self) -> float:
+        """
+        Fichas disponibles en este momento (negativo si hay peticiones esperando
+        o el cubo está bloqueado, infinito si no hay límite)
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            blocked = max(0, self.blocked_until - now)
+            if not self.fill:
+                return -blocked if blocked else float("inf")
+            return min(self.tokens, -blocked * self.fill) if blocked else self.tokens
+
+    def penalize(self, seconds: float):
+        """
+        Bloquea el cubo durante unos segundos (por ejemplo tras un 429) y lo deja vacío.
+        Varios bloqueos simultáneos (los 429 de todas las peticiones en vuelo) no se suman:
+        solo cuenta lo que cada uno alarga el bloqueo ya vigente
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            extra = max(0, now + seconds - max(self.blocked_until, now))
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            if self.fill:
+                self.tokens = min(self.tokens, 0) - extra * self.fill
+
+
+class RateLimiter:
+    def __init__(self, per: float = 60, **rates):
+        """
+        Limitador de peticiones con un presupuesto independiente por tipo de endpoint
+
+        :param per: periodo en segundos al que se refieren los límites
+        :param rates: número de peticiones permitidas cada `per` segundos para cada endpoint
+        """
+        self.per = per
+        self.buckets = {k: TokenBucket(v, per=per) for k, v in rates.items()}
+        self.lock = Lock()
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        """
+        Devuelve el cubo de un endpoint, creándolo (sin límite) si no existe
+        """
+        with self.lock:
+            b = self.buckets.get(endpoint)
+            if b is None:
+                b = TokenBucket(None, per=self.per)
+                self.buckets[endpoint] = b
+            return b
+
+    def reserve(self, endpoint: str) -> float:
+        return self.bucket(endpoint).reserve()
+
+    def acquire(self, endpoint: str) -> float:
+        return self.bucket(endpoint).acquire()
+
+    def penalize(self, endpoint: str, seconds: float):
+        logger.debug("%s bloqueado %ss", endpoint, seconds)
+        self.bucket(endpoint).penalize(seconds)
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from threading import Lock
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+logger = logging.getLogger(__name__)
+
+re_api_key = re.compile(r"([?&])api_key=[^&]*&?")
+
+
+class Corpus:
+    def __init__(self, path: str):
+        """
+        Corpus de respuestas de la Aemet grabadas en disco (modo record) para
+        poder servirlas después sin conexión (modo replay)
+
+        Cada respuesta se guarda en {sha1 de la url}.{n}.body y sus metadatos
+        (url, status y cabeceras) en {sha1 de la url}.{n}.json, siendo n el orden
+        en el que se obtuvo esa url (para reproducir también los reintentos).
+        La api key se elimina de la url antes de calcular el sha1
+
+        :param path: directorio del corpus (para grabar conviene usar uno vacío)
+        """
+        self.path = path
+        self.lock = Lock()
+        self.recorded = {}
+        self.served = {}
+        os.makedirs(self.path, exist_ok=True)
+        for fl in os.listdir(self.path):
+            if fl.endswith(".json"):
+                key, n, _ = fl.rsplit(".", 2)
+                self.recorded[key] = max(self.recorded.get(key, 0), int(n) + 1)
+
+    @staticmethod
+    def clean_url(url: str) -> str:
+        """
+        Elimina la api key de una url
+        """
+        return re_api_key.sub(lambda m: m.group(1), url).rstrip("?&")
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha1(Corpus.clean_url(url).encode()).hexdigest()
+
+    def _file(self, key: str, n: int, ext: str) -> str:
+        return os.path.join(self.path, "{}.{}.{}".format(key, n, ext))
+
+    def record(self, url: str, status_code: int, headers, content: bytes):
+        """
+        Graba una respuesta
+        """
+        key = self._key(url)
+        with self.lock:
+            n = self.recorded.get(key, 0)
+            self.recorded[key] = n + 1
+        with open(self._file(key, n, "body"), "wb") as f:
+            f.write(content)
+        with open(self._file(key, n, "json"), "w") as f:
+            json.dump(dict(url=Corpus.clean_url(url), status_code=status_code, headers=dict(headers)), f)
+
+    def load(self, url: str) -> tuple:
+        """
+        Obtiene la siguiente respuesta grabada de una url
+        (una vez agotadas se repite la última)
+
+        :return: tupla (status, cabeceras, contenido) o None si la url no se grabó
+        """
+        key = self._key(url)
+        with self.lock:
+            total = self.recorded.get(key, 0)
+            if total == 0:
+                return None
+            n = min(self.served.get(key, 0), total - 1)
+            self.served[key] = n + 1
+        with open(self._file(key, n, "json"), "r") as f:
+            meta = json.load(f)
+        with open(self._file(key, n, "body"), "rb") as f:
+            content = f.read()
+        return meta["status_code"], meta["headers"], content
+
+
+class RecordAdapter(HTTPAdapter):
+    def __init__(self, corpus: Corpus, *args, **kwargs):
+        """
+        HTTPAdapter que graba en un corpus todas las respuestas que obtiene
+        """
+        super().__init__(*args, **kwargs)
+        self.corpus = corpus
+
+    def send(self, request, **kwargs):
+        r = super().send(request, **kwargs)
+        # Lee el cuerpo aunque se haya pedido stream, la respuesta sigue pudiéndose iterar
+        self.corpus.record(request.url, r.status_code, r.headers, r.content)
+        return r
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, corpus: Corpus):
+        """
+        Adapter de requests que sirve las respuestas de un corpus sin conexión.
+        Las urls que no están en el corpus devuelven un 404
+        """
+        super().__init__()
+        self.corpus = corpus
+
+    def send(self, request, **kwargs):
+        rec = self.corpus.load(request.url)
+        if rec is None:
+            logger.warning("replay: %s no está en el corpus", Corpus.clean_url(request.url))
+            rec = (404, {}, b"")
+        status_code, headers, content = rec
+        r = Response()
+        r.status_code = status_code
+        r.headers = CaseInsensitiveDict(headers)
+        r._content = content
+        r._content_consumed = True
+        r.url = request.url
+        r.request = request
+        r.encoding = get_encoding_from_headers(r.headers)
+        return r
+
+    def close(self):
+        pass
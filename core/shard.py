@@ -0,0 +1,103 @@
+import logging
+
+from .bucket import Bucket
+
+logger = logging.getLogger(__name__)
+
+
+class Shard:
+    def __init__(self, index: int, total: int):
+        """
+        Parte del trabajo que le toca a una de varias ejecuciones en paralelo
+
+        :param index: número de la parte (empezando en 1)
+        :param total: número total de partes
+        """
+        if total < 1 or not (1 <= index <= total):
+            raise Exception("Shard incorrecto {}/{}".format(index, total))
+        self.index = index
+        self.total = total
+
+    @staticmethod
+    def parse(value: str):
+        """
+        Crea un Shard a partir de un texto i/n (por ejemplo 2/4)
+        """
+        if value in (None, ""):
+            return None
+        try:
+            index, total = (int(v) for v in value.split("/"))
+        except ValueError:
+            raise Exception("Shard incorrecto {}, se esperaba i/n".format(value))
+        return Shard(index, total)
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.total)
+
+    def assign(self, weights: dict) -> dict:
+        """
+        Reparte elementos entre las partes equilibrando su peso total (Longest Processing Time:
+        de más a menos pesado, cada elemento va a la parte con menos peso acumulado).
+        El reparto solo depende de los pesos, así que todas las ejecuciones obtienen el mismo
+        siempre que los pesos no dependan de lo que ya se ha subido a s3 (que cambia mientras
+        las otras partes trabajan) sino solo de los metadatos
+
+        :param weights: diccionario con clave el elemento y valor su peso (trabajo previsto)
+        :return: diccionario con clave el elemento y valor la parte asignada (empezando en 1)
+        """
+        load = [0] * self.total
+        rt = {}
+        for k, w in sorted(weights.items(), key=lambda kv: (-kv[1], str(kv[0]))):
+            i = min(range(self.total), key=lambda i: (load[i], i))
+            load[i] = load[i] + w
+            rt[k] = i + 1
+        return rt
+
+    def split(self, weights: dict) -> set:
+        """
+        Devuelve los elementos que le tocan a esta parte (ver assign)
+        """
+        rt = set(k for k, i in self.assign(weights).items() if i == self.index)
+        logger.info("shard %s: %s de %s elementos (peso %s de %s)", self, len(rt), len(weights),
+                    sum(weights[k] for k in rt), sum(weights.values()))
+        return rt
+
+    @staticmethod
+    def target(run: str, total: int, index: int = None) -> str:
+        """
+        Ruta en s3 de la lista need_update de una parte (o prefijo de todas si no se indica index)
+
+        :param run: identificador de la ejecución, común a todas las partes y a --merge
+        """
+        prefix = "shard/{}/{}/".format(run, total)
+        if index is None:
+            return prefix
+        return prefix + "{}.json".format(index)
+
+    def save(self, bucket: Bucket, run: str, need_update: list):
+        """
+        Guarda en s3 la lista de ficheros nuevos o modificados por esta parte
+        """
+        bucket.up_gz(sorted(set(need_update)), Shard.target(run, self.total, self.index))
+
+    @staticmethod
+    def merge(bucket: Bucket, run: str, total: int) -> list:
+        """
+        Une las listas need_update guardadas por todas las partes de una ejecución
+
+        :param bucket: bucket donde se han guardado
+        :param run: identificador de la ejecución
+        :param total: número total de partes
+        :return: lista de ficheros nuevos o modificados por cualquiera de las partes
+        """
+        rt = set()
+        missing = []
+        for index in range(1, total + 1):
+            data = bucket.get_json_gz(Shard.target(run, total, index) + ".gz")
+            if data is None:
+                missing.append(index)
+            else:
+                rt.update(data)
+        if missing:
+            raise Exception("Faltan los shards {} de {} de la ejecución {}".format(missing, total, run))
+        return sorted(rt)
@@ -1,10 +1,18 @@
-from queue import Queue
-from threading import Thread
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Queue
+from threading import Event, Lock, Thread, get_ident
 
+from .profiler import Profiler
 from .util import chunks
 
+logger = logging.getLogger(__name__)
 
-def _do_work(q: Queue, fnc, fix_param: tuple, rt: list, rt_null: list):
+
+def _do_work(q: Queue, fnc, fix_param: tuple, rt: list, rt_null: list, rt_error: list,
+             profile: Profiler = None, queued: float = None, name: str = None):
     """
     Ejecuta una función sobre los elementos de una Queue
 
@@ -13,31 +21,138 @@ def _do_work(q: Queue, fnc, fix_param: tuple, rt: list, rt_null: list):
     :param fix_param: Parámetros fijos de la función
     :param rt: Lista a poblar con los resultados de la función
     :param rt_null: Lista a poblar con los argumentos que hicieron a la función devolver None
+    :param rt_error: Lista a poblar con tuplas (argumentos, excepción) de las llamadas que fallaron
+    :param profile: Profiler en el que registrar cada tarea
+    :param queued: momento (time.monotonic) en el que se encolaron los parámetros
+    :param name: nombre de la etapa en el Profiler
     """
     while not q.empty():
         args = q.get()
-        r = fnc(*(fix_param + args))
-        if r is None:
-            rt_null.append(args[0] if len(args) == 1 else args)
-        else:
-            if isinstance(r, list):
-                rt.extend(r)
+        start = time.monotonic()
+        try:
+            r = fnc(*(fix_param + args))
+            if r is None:
+                rt_null.append(args[0] if len(args) == 1 else args)
             else:
-                rt.append(r)
-        q.task_done()
+                if isinstance(r, list):
+                    rt.extend(r)
+                else:
+                    rt.append(r)
+        except Exception as e:
+            logger.critical("ThreadMe " + str(args) + " > " + str(e), exc_info=True)
+            rt_error.append((args[0] if len(args) == 1 else args, e))
+        finally:
+            if profile is not None:
+                profile.task(name, queued, start, time.monotonic())
+            q.task_done()
     return True
 
 
+def _name(fnc) -> str:
+    return getattr(fnc, "__name__", None) or type(fnc).__name__
+
+
+class _End:
+    """
+    Marca de fin de datos en las colas del modo stream de ThreadMe y de pipeline
+    """
+    pass
+
+
+class _Pool:
+    def __init__(self, stop: Event = None):
+        """
+        Estado compartido de un pool persistente de ThreadMe o de una etapa de pipeline
+
+        :param stop: Event compartido con otros pools (por defecto uno propio)
+        """
+        self.lock = Lock()
+        self.stop = stop or Event()
+        # índice (o hilo en pipeline) -> (argumentos, inicio) de las tareas en ejecución
+        self.running = {}
+        # índices (o hilos) de las tareas abandonadas por superar su timeout
+        self.cancelled = set()
+
+
+def _do_pool(q_in: Queue, q_out: Queue, fnc, fix_param: tuple, pool: _Pool, profile: Profiler = None,
+             name: str = None):
+    """
+    Hilo de un pool persistente: ejecuta la función sobre los elementos (índice, argumentos, encolado)
+    de q_in hasta recibir _End y deja en q_out las tuplas (índice, argumentos, resultado, excepción).
+    Si su tarea se abandona por superar el timeout, el hilo termina sin devolver nada
+    (ya se ha lanzado otro en su lugar)
+    """
+    while not pool.stop.is_set():
+        item = q_in.get()
+        if isinstance(item, _End):
+            q_out.put(item)
+            break
+        i, args, queued = item
+        start = time.monotonic()
+        with pool.lock:
+            pool.running[i] = (args, start)
+        r = None
+        error = None
+        try:
+            r = fnc(*(fix_param + args))
+        except Exception as e:
+            logger.critical("ThreadMe " + str(args) + " > " + str(e), exc_info=True)
+            error = e
+        if profile is not None:
+            profile.task(name, queued, start, time.monotonic())
+        with pool.lock:
+            if i in pool.cancelled:
+                return
+            pool.running.pop(i, None)
+        q_out.put((i, args, r, error))
+
+
+def _do_index_feed(data, q: Queue, workers: int, error: list, pool: _Pool):
+    """
+    Llena la cola de un pool persistente con tuplas (índice, argumentos, encolado)
+    y al terminar (o fallar el iterable de datos) avisa a todos los hilos
+    """
+    try:
+        for i, d in enumerate(data):
+            if pool.stop.is_set():
+                return
+            q.put((i, d if isinstance(d, tuple) else (d,), time.monotonic()))
+    except Exception as e:
+        error.append(e)
+    finally:
+        for _ in range(workers):
+            q.put(_End())
+
+
 class ThreadMe:
-    def __init__(self, fix_param=None, max_thread=10, list_size=2000):
+    def __init__(self, fix_param=None, max_thread=10, list_size=2000, stream: bool = False, ordered: bool = False,
+                 timeout: float = None, deadline: float = None, profile: Profiler = None):
         """
         Paraleliza una función sobre elementos de una lista
 
         :param fix_param: Parámetros fijos que se van a pasar a cada trabajo
         :param max_thread: Máximo numero de hilos a utilizar
         :param list_size: Tamaño máximo de la lista a devolver
+        :param stream: indica que se use un único pool de hilos durante toda la ejecución,
+            con la cola de entrada siempre llena y devolviendo cada resultado en cuanto termina
+            (en vez de trabajar por bloques de max_thread elementos)
+        :param ordered: en modo stream, indica que los resultados se devuelvan en el orden de los datos
+        :param timeout: segundos máximos de cada trabajo. Los que lo superan se abandonan
+            (se registran en rt_error con un TimeoutError y otro hilo ocupa su lugar)
+        :param deadline: segundos máximos de toda la ejecución. Al superarlos se abandonan los
+            trabajos en curso (se registran en rt_error) y pendientes y run termina con los
+            resultados obtenidos hasta entonces
+        timeout y deadline implican el modo stream
+        :param profile: Profiler en el que registrar la espera en cola y la ejecución de cada tarea
         """
         self.max_thread = max_thread
+        self.stream = stream or timeout is not None or deadline is not None
+        self.ordered = ordered
+        self.timeout = timeout
+        self.deadline = deadline
+        self.profile = profile
+        # Nombre de la etapa en el Profiler
+        self.stage = None
         if fix_param is None:
             fix_param = tuple()
         elif not isinstance(fix_param, tuple):
@@ -45,6 +160,7 @@ class ThreadMe:
         self.fix_param = fix_param
         self.list_size = list_size
         self.rt_null = []
+        self.rt_error = []
 
     def run(self, do_work, data, return_first: bool = False):
         """
@@ -59,6 +175,12 @@ class ThreadMe:
         if return_first:
             for i in next(data):
                 yield i
+        if self.profile is not None:
+            self.stage = self.profile.stage(_name(do_work), self.max_thread)
+        if self.stream:
+            for i in self._run_stream(do_work, data):
+                yield i
+            return
         for dt in chunks(data, self.max_thread):
             q = Queue(maxsize=0)
             rt = []
@@ -66,14 +188,134 @@ class ThreadMe:
                 if not isinstance(d, tuple):
                     d = (d,)
                 q.put(d)
+            queued = time.monotonic()
             for i in range(len(dt)):
-                worker = Thread(target=_do_work, args=(q, do_work, self.fix_param, rt, self.rt_null))
+                worker = Thread(target=_do_work, args=(q, do_work, self.fix_param, rt, self.rt_null, self.rt_error,
+                                                       self.profile, queued, self.stage))
                 worker.setDaemon(True)
                 worker.start()
             q.join()
             for i in rt:
                 yield i
 
+    def _emit(self, args: tuple, r, error: Exception = None):
+        arg = args[0] if len(args) == 1 else args
+        if error is not None:
+            self.rt_error.append((arg, error))
+        elif r is None:
+            self.rt_null.append(arg)
+        elif isinstance(r, list):
+            for i in r:
+                yield i
+        else:
+            yield r
+
+    def _start_worker(self, q_in: Queue, q_out: Queue, do_work, pool: _Pool):
+        worker = Thread(target=_do_pool, args=(q_in, q_out, do_work, self.fix_param, pool, self.profile,
+                                               self.stage))
+        worker.setDaemon(True)
+        worker.start()
+
+    def _wait(self, pool: _Pool, start: float) -> float:
+        """
+        Segundos que se puede esperar un resultado antes de tener que revisar timeout y deadline
+        """
+        now = time.monotonic()
+        limits = []
+        if self.deadline is not None:
+            limits.append(start + self.deadline)
+        if self.timeout is not None:
+            with pool.lock:
+                starts = [t for _, t in pool.running.values()]
+            limits.append((min(starts) if starts else now) + self.timeout)
+        if not limits:
+            return None
+        return max(0.001, min(limits) - now)
+
+    def _expire(self, pool: _Pool, now: float, all: bool = False) -> list:
+        """
+        Abandona las tareas en ejecución que han superado el timeout (o todas si all = True)
+
+        :return: lista de tuplas (índice, argumentos) de las tareas abandonadas
+        """
+        expired = []
+        with pool.lock:
+            for i, (args, t) in list(pool.running.items()):
+                if all or now - t >= self.timeout:
+                    pool.running.pop(i)
+                    pool.cancelled.add(i)
+                    expired.append((i, args, now - t))
+        for i, args, t in expired:
+            logger.warning("ThreadMe %s > abandonado tras %ss", _brief(args), round(t, 1))
+        return [(i, args) for i, args, _ in expired]
+
+    def _run_stream(self, do_work, data):
+        """
+        Ejecuta run con un pool de hilos persistente (ver stream, timeout y deadline en __init__)
+        """
+        q_in = Queue(maxsize=2 * self.max_thread)
+        q_out = Queue(maxsize=0)
+        pool = _Pool()
+        error = []
+        start = time.monotonic()
+        feeder = Thread(target=_do_index_feed, args=(data, q_in, self.max_thread, error, pool))
+        feeder.setDaemon(True)
+        feeder.start()
+        for _ in range(self.max_thread):
+            self._start_worker(q_in, q_out, do_work, pool)
+        ended = 0
+        pending = {}
+        nxt = 0
+        try:
+            while ended < self.max_thread:
+                try:
+                    item = q_out.get(timeout=self._wait(pool, start))
+                except Empty:
+                    item = None
+                now = time.monotonic()
+                if self.deadline is not None and now - start >= self.deadline:
+                    pool.stop.set()
+                    for i, args in self._expire(pool, now, all=True):
+                        self.rt_error.append((args[0] if len(args) == 1 else args, TimeoutError("deadline")))
+                    logger.warning("ThreadMe: deadline de %ss superado, se devuelven resultados parciales",
+                                   self.deadline)
+                    break
+                if self.timeout is not None:
+                    for i, args in self._expire(pool, now):
+                        self.rt_error.append((args[0] if len(args) == 1 else args, TimeoutError("timeout")))
+                        self._start_worker(q_in, q_out, do_work, pool)
+                        if self.ordered:
+                            pending[i] = None
+                if item is None:
+                    pass
+                elif isinstance(item, _End):
+                    ended = ended + 1
+                elif not self.ordered:
+                    i, args, r, e = item
+                    for x in self._emit(args, r, e):
+                        yield x
+                else:
+                    i, args, r, e = item
+                    pending[i] = (args, r, e)
+                if self.ordered:
+                    while nxt in pending:
+                        p = pending.pop(nxt)
+                        if p is not None:
+                            for x in self._emit(*p):
+                                yield x
+                        nxt = nxt + 1
+        finally:
+            # Tras el deadline o si se deja de consumir el generador, los hilos terminan sin vaciar q_in:
+            # se vacía para que el feeder no se quede bloqueado y pueda avisar a los que esperan datos
+            pool.stop.set()
+            while True:
+                try:
+                    q_in.get_nowait()
+                except Empty:
+                    break
+        if error:
+            raise error[0]
+
     def list_run(self, *args, **kwargs):
         """
         Ejecuta la función para cada elemento de la lista y va devolviendo los resultados con un generador
@@ -81,3 +323,233 @@ class ThreadMe:
         """
         for arr in chunks(self.run(*args, **kwargs), self.list_size):
             yield arr
+
+
+def _brief(args: tuple, size: int = 80) -> str:
+    """
+    Argumentos de una tarea recortados para el log (pueden incluir xml o json completos)
+    """
+    return "(" + ", ".join(r if len(r) <= size else r[:size] + "..." for r in map(repr, args)) + ")"
+
+
+def _do_stage(q_in: Queue, q_out: Queue, fnc, state: list, pool: _Pool, next_workers: int,
+              profile: Profiler = None, name: str = None, errors: list = None):
+    """
+    Ejecuta una etapa de un pipeline sobre los elementos de una Queue
+
+    :param q_in: Queue de la que se leen los elementos (tuplas (encolado, argumentos))
+    :param q_out: Queue en la que se escriben los resultados
+    :param fnc: Función a ejecutar
+    :param state: lista con el número de hilos de la etapa que siguen vivos (protegida por pool.lock)
+    :param pool: estado de la etapa: tareas en ejecución (por hilo) para que pipeline revise su timeout,
+        hilos abandonados y aviso de deadline superado (tras el que se descartan los elementos)
+    :param next_workers: número de hilos de la siguiente etapa (a los que hay que notificar el fin)
+    :param profile: Profiler en el que registrar cada tarea
+    :param name: nombre de la etapa en el Profiler
+    :param errors: Lista a poblar con tuplas (etapa, argumentos, excepción) de las tareas que fallaron
+    Si su tarea se abandona por superar el timeout, el hilo termina sin devolver nada
+    (ya se ha lanzado otro en su lugar)
+    """
+    me = get_ident()
+    while True:
+        item = q_in.get()
+        if isinstance(item, _End):
+            break
+        if pool.stop.is_set():
+            continue
+        queued, args = item
+        start = time.monotonic()
+        with pool.lock:
+            pool.running[me] = (args, start)
+        r = None
+        try:
+            r = fnc(*args)
+        except Exception as e:
+            logger.critical("pipeline %s %s > %s", name, _brief(args), e, exc_info=True)
+            if errors is not None:
+                errors.append((name, args, e))
+        if profile is not None:
+            profile.task(name, queued, start, time.monotonic())
+        with pool.lock:
+            if me in pool.cancelled:
+                pool.cancelled.discard(me)
+                return
+            pool.running.pop(me, None)
+        if r is not None and not pool.stop.is_set():
+            q_out.put((time.monotonic(), r if isinstance(r, tuple) else (r,)))
+    with pool.lock:
+        state[0] = state[0] - 1
+        last = state[0] == 0
+    if last:
+        for i in range(next_workers):
+            q_out.put(_End())
+
+
+def _do_feed(data, q: Queue, workers: int, error: list, stop: Event = None):
+    """
+    Llena la primera cola de un pipeline y al terminar (o fallar el iterable de datos
+    o superarse el deadline) avisa a todos los hilos de la primera etapa
+    """
+    try:
+        for d in data:
+            if stop is not None and stop.is_set():
+                break
+            q.put((time.monotonic(), d if isinstance(d, tuple) else (d,)))
+    except Exception as e:
+        error.append(e)
+    finally:
+        for i in range(workers):
+            q.put(_End())
+
+
+def _mp_context():
+    """
+    Contexto de multiprocessing de los pools de procesos: forkserver (o spawn donde no existe)
+    en lugar de fork, porque hacer fork con hilos en marcha copia los locks que tengan tomados
+    (logging, colas, conexiones) y el proceso hijo puede quedarse bloqueado para siempre
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _in_process(executor: ProcessPoolExecutor, fnc):
+    """
+    Envuelve una función para que los hilos de una etapa la ejecuten en un pool de procesos
+    """
+    def run(*args):
+        return executor.submit(fnc, *args).result()
+    return run
+
+
+def _expire(pool: _Pool, now: float, timeout: float) -> list:
+    """
+    Abandona las tareas en ejecución de una etapa de un pipeline que han superado el timeout
+
+    :return: lista de tuplas (argumentos, inicio) de las tareas abandonadas
+    """
+    expired = []
+    with pool.lock:
+        for me, (args, t) in list(pool.running.items()):
+            if now - t >= timeout:
+                pool.running.pop(me)
+                pool.cancelled.add(me)
+                expired.append((args, t))
+    return expired
+
+
+def pipeline(data, *stages, maxsize: int = None, profile: Profiler = None, timeout: list = None,
+             deadline: float = None, errors: list = None):
+    """
+    Encadena varias funciones, cada una ejecutada por su propio grupo de hilos,
+    comunicadas mediante colas acotadas, de manera que una etapa lenta
+    no frena a las anteriores mientras haya hueco en su cola
+
+    Las etapas que consumen CPU (parseo, normalización, compresión) pueden ejecutarse
+    en un pool de procesos para no competir por el GIL con los hilos de las etapas de E/S.
+    En ese caso la función ha de poder pasarse a otro proceso (definida a nivel de módulo,
+    los procesos se crean con forkserver o spawn y no heredan el estado del proceso principal)
+    y sus parámetros y resultado se copian entre procesos, así que conviene que sean
+    datos simples (por ejemplo los bytes tal cual se descargaron)
+
+    :param data: iterable con los parámetros de la primera etapa
+    :param stages: tuplas (función, número de hilos) o (función, número de procesos, True)
+        para ejecutarla en un pool de procesos. Cada función recibe como parámetros
+        el resultado de la etapa anterior (si es una tupla se expande). Si devuelve None
+        el elemento se descarta
+    :param maxsize: tamaño máximo de cada cola (por defecto el doble de hilos que la consumen)
+    :param profile: Profiler en el que registrar la espera en cola y la ejecución de cada tarea
+        (cada etapa con el nombre de su función)
+    :param timeout: segundos máximos de cada tarea, un valor por etapa (None para no limitarla).
+        Las tareas que lo superan se abandonan (se registran en errors con un TimeoutError,
+        su elemento se descarta y otro hilo ocupa su lugar), así que no conviene limitar
+        etapas con estado o que no deban quedarse a medias
+    :param deadline: segundos máximos de todo el pipeline. Al superarlos se descartan los elementos
+        pendientes y los resultados de las tareas en curso y el generador termina con los resultados
+        obtenidos hasta entonces (tras esperar a las tareas en curso de las etapas sin timeout)
+    :param errors: Lista a poblar con tuplas (etapa, argumentos, excepción) de las tareas que fallaron
+    :return: Generador con los resultados de la última etapa en orden de finalización.
+        Si el iterable de datos lanza una excepción, se relanza al terminar
+    """
+    workers = [stage[1] for stage in stages]
+    timeout = list(timeout or []) + [None] * (len(stages) - len(timeout or []))
+    queues = [Queue(maxsize=maxsize or 2 * n) for n in workers]
+    queues.append(Queue(maxsize=0))
+    # Los pools de procesos se crean antes de arrancar ningún hilo
+    executors = {}
+    for i, stage in enumerate(stages):
+        if len(stage) > 2 and stage[2]:
+            executors[i] = ProcessPoolExecutor(max_workers=stage[1], mp_context=_mp_context())
+    error = []
+    stop = Event()
+    start = time.monotonic()
+    feeder = Thread(target=_do_feed, args=(data, queues[0], workers[0], error, stop))
+    feeder.setDaemon(True)
+    feeder.start()
+    pools = []
+    names = []
+    starters = []
+    for i, stage in enumerate(stages):
+        fnc, n = stage[:2]
+        name = _name(fnc)
+        if profile is not None:
+            name = profile.stage(name, n)
+        if i in executors:
+            fnc = _in_process(executors[i], fnc)
+        pool = _Pool(stop)
+        args = (queues[i], queues[i + 1], fnc, [n], pool, workers[i + 1] if i + 1 < len(workers) else 1,
+                profile, name, errors)
+
+        def start_worker(args=args):
+            worker = Thread(target=_do_stage, args=args)
+            worker.setDaemon(True)
+            worker.start()
+
+        pools.append(pool)
+        names.append(name)
+        starters.append(start_worker)
+        for _ in range(n):
+            start_worker()
+    q = queues[-1]
+    try:
+        while True:
+            now = time.monotonic()
+            limits = [] if deadline is None else [start + deadline]
+            for i, pool in enumerate(pools):
+                if timeout[i] is None:
+                    continue
+                for args, t in _expire(pool, now, timeout[i]):
+                    logger.warning("pipeline %s %s > abandonado tras %ss", names[i], _brief(args), round(now - t, 1))
+                    if errors is not None:
+                        errors.append((names[i], args, TimeoutError("timeout")))
+                    starters[i]()
+                with pool.lock:
+                    starts = [t for _, t in pool.running.values()]
+                if starts:
+                    limits.append(min(starts) + timeout[i])
+            if deadline is not None and now - start >= deadline:
+                stop.set()
+                logger.warning("pipeline > deadline de %ss superado, se descartan los elementos pendientes",
+                               deadline)
+                break
+            try:
+                r = q.get(timeout=max(0.001, min(limits) - now) if limits else None)
+            except Empty:
+                continue
+            if isinstance(r, _End):
+                break
+            r = r[1]
+            yield r[0] if len(r) == 1 else r
+    finally:
+        stop.set()
+        # Las tareas de las etapas sin timeout no se abandonan a medias
+        for i, pool in enumerate(pools):
+            while timeout[i] is None:
+                with pool.lock:
+                    if not pool.running:
+                        break
+                time.sleep(0.01)
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+    if error:
+        raise error[0]
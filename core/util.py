@@ -1,7 +1,9 @@
 import argparse
+import codecs
 import json
 import logging
 import os
+import re
 from datetime import datetime
 
 import yaml
@@ -21,6 +23,72 @@ def chunks(lst, n):
         yield arr
 
 
+def lpt(items, cost) -> list:
+    """
+    Ordena elementos de más a menos costosos (Longest Processing Time first): con un número fijo
+    de hilos, empezar por los trabajos largos evita que uno de ellos se quede solo al final
+    alargando toda la ejecución
+
+    :param items: iterable de elementos (se consume entero)
+    :param cost: función que devuelve el coste estimado de un elemento
+    :return: lista ordenada (los empates mantienen el orden original)
+    """
+    return sorted(items, key=cost, reverse=True)
+
+
+re_json_sep = re.compile(r"[\s,]*")
+
+
+def iter_json_array(chunks, encoding: str = "latin-1"):
+    """
+    Decodifica de manera incremental un array json, sin construir el texto completo
+
+    :param chunks: iterable de bytes con el contenido del array
+    :param encoding: encoding del contenido
+    :return: Generador con los elementos del array
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    js = json.JSONDecoder()
+    buf = ""
+    started = False
+    final = False
+    chunks = iter(chunks)
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+            buf = buf + decoder.decode(b"", final=True)
+        else:
+            buf = buf + decoder.decode(chunk)
+        pos = 0
+        while True:
+            pos = re_json_sep.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Se esperaba un array json")
+                started = True
+                pos = pos + 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                obj, pos_end = js.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                # Elemento incompleto, hace falta leer más
+                break
+            if not final and (pos_end >= len(buf) or isinstance(obj, (int, float)) and buf[pos_end] not in " \t\r\n,]"):
+                # Un número cortado al final del buffer (12|34, 3.5|e2) puede seguir en el siguiente trozo
+                break
+            yield obj
+            pos = pos_end
+        buf = buf[pos:]
+    raise ValueError("Array json incompleto")
+
+
 def save_js(file, *datas, indent=2, **kwargs):
     separators = (',', ':') if indent is None else None
     with open(file, "w") as f:
@@ -90,7 +158,11 @@ def mkArg(main, **kwargs):
     parser.add_argument('--muteaws', action='store_true', help="Silencia los logs de AWS")
 
     for k, v in kwargs.items():
-        parser.add_argument('--' + k, action='store_true', help=v)
+        if isinstance(v, dict):
+            # Argumentos con valor: el diccionario son los kwargs de add_argument
+            parser.add_argument('--' + k, **v)
+        else:
+            parser.add_argument('--' + k, action='store_true', help=v)
     args = parser.parse_args()
 
     levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -8,6 +8,7 @@ from core.athena import Athena
 from core.bucket import Bucket
 from core.db import DB
 from core.glue import Glue
+from core.shard import Shard
 from core.util import mkArg
 from scripts.scrap import Scrap
 from scripts.update import Update
@@ -17,7 +18,12 @@ arg = mkArg(
     mes="Trata los datos mensuales",
     dia="Trata los datos diarios",
     pre="Trata los datos de predicción",
-    glue="Ejecutar Glue"
+    glue="Ejecutar Glue",
+    run=dict(metavar="id", help="Identificador de la ejecución (por defecto RUN_ID o la fecha y hora). "
+                                "Repitiéndolo se retoma una ejecución interrumpida"),
+    shard=dict(metavar="i/n", help="Hace solo la parte i de n del scraping (sin Glue ni actualización)"),
+    merge=dict(metavar="n", type=int, help="No hace scraping, une el resultado de los n shards de --run "
+                                           "y sigue con Glue y la actualización de la base de datos")
 )
 
 logger = logging.getLogger(__name__)
@@ -27,16 +33,30 @@ if not (arg.mes or arg.dia or arg.pre):
 
 bucket = Bucket(os.environ['S3_TARGET'])
 
-sc = Scrap(bucket)
-
-if arg.dia:
-    sc.do_dia()
-if arg.mes:
-    sc.do_mes()
-if arg.pre:
-    sc.do_prediccion()
-
-if not sc.need_update():
+run = arg.run or os.environ.get("RUN_ID")
+if (arg.shard or arg.merge) and not run:
+    sys.exit("--shard y --merge necesitan un --run (o RUN_ID) común a todas las partes")
+
+if arg.merge:
+    need_update = Shard.merge(bucket, run, arg.merge)
+else:
+    shard = Shard.parse(arg.shard)
+    sc = Scrap(bucket, shard=shard, run=run)
+
+    if arg.dia:
+        sc.do_dia()
+    if arg.mes:
+        sc.do_mes()
+    if arg.pre:
+        sc.do_prediccion()
+
+    need_update = sc.need_update()
+    if shard is not None:
+        shard.save(bucket, run, need_update)
+        logger.info("Shard %s terminado, el resto se hará con --merge %s --run %s", shard, shard.total, run)
+        sys.exit()
+
+if not need_update:
     logger.info("No hay nada que actualizar")
     sys.exit()
 
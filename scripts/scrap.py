@@ -1,147 +1,513 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
 import os
-import re
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from functools import lru_cache
+from threading import Lock
+
+from munch import Munch
 
 from core.aemet import Aemet
-from core.bucket import Bucket
+from core.archive import INDEX_META, ArchiveWriter
+from core.asyncaemet import AsyncAemet
+from core.bucket import Bucket, LocalBucket
+from core.checkpoint import Checkpoint
+from core.cost import CostModel
 from core.glue import Glue
-from core.threadme import ThreadMe
-from core.util import YEAR_UPDATE, YEAR, mkArg
-
-re_year = re.compile(r".*/year=(\d+).*")
+from core.metacache import MetaCache
+from core.profiler import Profiler
+from core.prediccion import parse_prediccion_raw
+from core.shard import Shard
+from core.threadme import ThreadMe, pipeline
+from core.util import YEAR_UPDATE, YEAR, lpt, mkArg
 
 logger = logging.getLogger(__name__)
 
 
+def _parse_prediccion(prov: str, total: int, num_data: Munch, parsed: bool) -> tuple:
+    """
+    Etapa de Scrap.do_prediccion que parsea en un pool de procesos los xml descargados
+    (ha de estar a nivel de módulo para poder ejecutarse en otro proceso)
+    """
+    if num_data is None or "content" not in num_data:
+        return prov, total, num_data, parsed
+    num_data = parse_prediccion_raw(num_data)
+    return prov, total, num_data, num_data is not None
+
+
 class Scrap:
-    def __init__(self, bucket: Bucket):
-        """
-        Extrae información de la Aemet y la guarda en s3
+    """
+    Extrae información de la Aemet y la guarda en s3
+
+    Atributos:
+        MAX_THREAD: número de hilos con los que se consulta la Aemet
+        UPLOAD_THREAD: número de hilos con los que se sube a s3 el histórico
+        DIA_INCREMENTAL: indica si los años de YEAR_UPDATE ya guardados del histórico diario
+            se actualizan pidiendo solo los días posteriores al último guardado
+        DIA_OVERLAP: días ya guardados que se vuelven a pedir en la actualización incremental
+            (por si la Aemet ha corregido los últimos datos)
+        PARSE_PROCESSES: número de procesos con los que se parsean las predicciones
+            (con 0 se parsean en los mismos hilos que las descargan)
+        PREDICCION_TIMEOUT: segundos máximos de cada tarea del pipeline de predicciones
+        PREDICCION_DEADLINE: segundos máximos de todo el pipeline de predicciones
+        PROFILE: directorio en el que guardar la línea temporal (formato Trace Event de Chrome)
+            de los hilos de cada tarea, cuyo resumen se escribe en el log (ver core.profiler)
+    """
+    MAX_THREAD = 30
+    UPLOAD_THREAD = 8
+    DIA_INCREMENTAL = os.environ.get("DIA_INCREMENTAL", "true") != "false"
+    DIA_OVERLAP = int(os.environ.get("DIA_OVERLAP", 3))
+    PARSE_PROCESSES = int(os.environ.get("PARSE_PROCESSES", 0))
+    PREDICCION_TIMEOUT = float(os.environ["PREDICCION_TIMEOUT"]) if os.environ.get("PREDICCION_TIMEOUT") else None
+    PREDICCION_DEADLINE = float(os.environ["PREDICCION_DEADLINE"]) if os.environ.get("PREDICCION_DEADLINE") else None
+    PROFILE = os.environ.get("THREAD_PROFILE")
 
+    def __init__(self, bucket: Bucket, shard: Shard = None, run: str = None):
+        """
         :param bucket: bucket donde se guardaran los datos extraídos
+        :param shard: parte del trabajo a realizar si se reparte entre varias ejecuciones
+        :param run: identificador de la ejecución (por defecto la variable de entorno RUN_ID
+            o la fecha y hora actuales). Repitiéndolo se retoma una ejecución interrumpida
         """
         self.bucket = bucket
-        self.api = Aemet()
+        self.shard = shard
+        self.run = run or os.environ.get("RUN_ID") or datetime.now().strftime("%Y%m%dT%H%M%S")
+        self.api = Aemet(pool_size=Scrap.MAX_THREAD)
+        # Al grabar o reproducir un corpus (ver core.replay) no se usa nada de ejecuciones anteriores
+        if self.api.meta is None and self.api.corpus is None:
+            self.api.meta = MetaCache(bucket=bucket, target="cache/AEMET/meta.json", ttl=Aemet.META_TTL)
+        if not self.api.replay:
+            # Cada shard aprende los costes de su parte para no pisar el modelo de los demás
+            target = "cache/AEMET/cost.json"
+            if self.shard is not None:
+                target = "cache/AEMET/cost-shard-{}-{}.json".format(self.shard.index, self.shard.total)
+            self.api.costs = CostModel(bucket=bucket, target=target)
+        self.checkpoints = {}
+
+    def checkpoint(self, table: str) -> Checkpoint:
+        """
+        Devuelve el manifiesto de unidades terminadas de una tabla
+        (s3://.../checkpoint/{table}/{nombre}/ y, si se define CHECKPOINT_DIR, un fichero local)
+
+        En el histórico el manifiesto es el del día (los años ya actualizados hoy no se repiten),
+        en la predicción es el de la ejecución, ya que cada nueva ejecución ha de volver a pedir
+        todos los municipios por si hay una nueva elaboración
+        """
+        if table not in self.checkpoints:
+            if self.api.corpus is not None:
+                # Al grabar o reproducir un corpus se hacen siempre todas las consultas
+                self.checkpoints[table] = Checkpoint()
+                return self.checkpoints[table]
+            name = str(date.today())
+            if table == "PREDICCION":
+                name = "run-" + self.run
+            if self.shard is not None:
+                # Cada shard tiene su propio manifiesto para no pisarse
+                name = "{}-shard-{}-{}".format(name, self.shard.index, self.shard.total)
+            file = None
+            if os.environ.get("CHECKPOINT_DIR"):
+                file = os.path.join(os.environ["CHECKPOINT_DIR"], "{}-{}.jsonl".format(table, name))
+            self.checkpoints[table] = Checkpoint(
+                self.bucket,
+                target="checkpoint/{}/{}/".format(table, name),
+                file=file
+            )
+        return self.checkpoints[table]
 
     @property
     @lru_cache(maxsize=None)
     def bases(self) -> list:
         """
         Devuelve y guarda las bases de la AEMET
+        (si vienen de la caché de metadatos solo se guardan si han cambiado o aún no existen)
         """
         if not self.api.bases:
             raise Exception("Bases no encontradas")
-        self.bucket.up_gz(self.api.bases, "raw/AEMET/BASES/", comment=self.api.last_url)
+        meta = self.api.meta
+        if meta is None or "bases" in meta.changed or not self.bucket.exist("raw/AEMET/BASES/data.json.gz"):
+            self.bucket.up_gz(self.api.bases, "raw/AEMET/BASES/", comment=self.api.url.estaciones)
+        if meta is not None:
+            meta.save()
         return self.api.bases
 
     def get_years(self, table: str, base: str) -> set:
         """
         Devuelve la lista de años de los que ya tenemos datos consolidados para una tabla y una base
-        Para ello obtiene los años para los que ya existe un fichero en s3 y de ellos descarta
-        aquellos que aún pueden haber cambiado desde la última ejecución
+        Para ello obtiene los años para los que ya existe un fichero en s3 (según el índice
+        de particiones del bucket, que se crea con un único listado por tabla) y de ellos descarta
+        aquellos que aún pueden haber cambiado desde la última ejecución, salvo que ya se hayan
+        actualizado hoy según el manifiesto de la tabla
         """
-        years = set()
-        for fl in self.bucket.s3glob("raw/AEMET/{}/base={}/year=*".format(table, base)):
-            m = re_year.search(fl)
-            years.add(int(m.group(1)))
+        years = set(int(y) for y in self.bucket.partitions("raw/AEMET/{}/".format(table), base))
+        checkpoint = self.checkpoint(table)
         for y in YEAR_UPDATE:
-            if y in years:
+            if y in years and not checkpoint.is_done(table, base, y):
                 years.remove(y)
         return years
 
+    def get_missing(self, table: str) -> dict:
+        """
+        Devuelve los años que faltan por consultar de cada base para una tabla
+        """
+        missing = {}
+        for b in self.bases:
+            years = set(range(Aemet.YEAR_ZERO, YEAR + 1)) - self.get_years(table, b['indicativo'])
+            if years:
+                missing[b['indicativo']] = years
+        if self.shard is not None:
+            # Se reparten todas las bases (no solo las pendientes), ya que los años pendientes
+            # cambian mientras trabajan los demás shards o al retomar uno interrumpido
+            bases = self.shard.split({b['indicativo']: 1 for b in self.bases})
+            missing = {b: years for b, years in missing.items() if b in bases}
+        return missing
+
+    def get_provincias(self) -> dict:
+        """
+        Devuelve los municipios de cada provincia (de las que le tocan a este shard),
+        empezando por las que se estima que más van a tardar
+        """
+        provs = {}
+        for prov in self.api.get_provincias():
+            muns = self.api.get_municipios(prov)
+            if muns:
+                provs[prov] = muns
+        if self.api.meta is not None:
+            self.api.meta.save()
+        if self.shard is not None:
+            keep = self.shard.split({prov: len(muns) for prov, muns in provs.items()})
+            provs = {prov: muns for prov, muns in provs.items() if prov in keep}
+        return dict(lpt(provs.items(), self.prov_cost))
+
+    def prov_cost(self, prov_muns: tuple) -> float:
+        """
+        Coste estimado de la predicción de una provincia (por su número de municipios
+        y lo que tardaron sus municipios en ejecuciones anteriores)
+        """
+        prov, muns = prov_muns
+        if self.api.costs is None:
+            return len(muns)
+        return self.api.costs.estimate("PREDICCION", prov, len(muns))
+
+    @contextmanager
+    def profile(self, name: str):
+        """
+        Contexto que, si se ha definido PROFILE, devuelve un Profiler en el que también se marcan
+        las peticiones a la Aemet y las esperas del limitador, y al terminar escribe su resumen
+        en el log y guarda su línea temporal en PROFILE/{name}.trace.json
+        """
+        if not Scrap.PROFILE:
+            yield None
+            return
+        profile = Profiler(name)
+        self.api.metrics.profiler = profile
+        try:
+            yield profile
+        finally:
+            self.api.metrics.profiler = None
+            profile.stop()
+            profile.log_summary()
+            os.makedirs(Scrap.PROFILE, exist_ok=True)
+            profile.dump(os.path.join(Scrap.PROFILE, name + ".trace.json"))
+
+    def save_costs(self):
+        """
+        Guarda lo aprendido sobre el coste de cada consulta para planificar la próxima ejecución
+        """
+        if self.api.costs is not None:
+            self.api.costs.save()
+
+    def _up_years(self, table: str, job, year_data: dict):
+        """
+        Sube a s3 los años pendientes de una consulta del histórico
+
+        :return: número de años subidos
+        """
+        count = 0
+        for year, data in year_data.items():
+            if data is None or year not in job.years:
+                continue
+            target = "raw/AEMET/{}/base={}/year={}/".format(table, job.id, year)
+            if len(data) == 0:
+                # Creamos un txt para que la entrada no se quede vacía
+                # impidiéndonos detectar que este año ya se ha tratado
+                target = "raw/AEMET/{}/base={}/year={}.txt".format(table, job.id, year)
+            self.bucket.up_gz(
+                data,
+                target,
+                comment=job.url
+            )
+            self.checkpoint(table).done((table, job.id, year), data)
+            count = count + 1
+        return count
+
+    def _get_stored(self, table: str, base: str, year: int) -> tuple:
+        """
+        Descarga los datos ya guardados de una base y año
+
+        :return: tupla (base, año, lista de registros)
+        """
+        data = self.bucket.get_json_gz("raw/AEMET/{}/base={}/year={}/data.json.gz".format(table, base, year))
+        return base, year, data or []
+
+    def _up_incremental(self, table: str, stored: dict, job, year_data: dict):
+        """
+        Une por fecha los datos nuevos de una consulta incremental con los ya guardados
+        y sube los años que han cambiado
+
+        :param stored: diccionario {base: {año: registros guardados}}
+        :return: número de años subidos o None si la consulta ha fallado
+        """
+        if year_data is None:
+            return None
+        changed = {}
+        for year in job.years:
+            old = stored[job.id][year]
+            merged = {d["fecha"]: d for d in old}
+            for d in year_data.get(year) or []:
+                merged[d["fecha"]] = d
+            merged = [merged[k] for k in sorted(merged)]
+            if merged != old:
+                changed[year] = merged
+            else:
+                self.checkpoint(table).done((table, job.id, year), old)
+        logger.info("DIARIO %s incremental: %s de %s años cambiados", job.id, len(changed), len(job.years))
+        return self._up_years(table, job, changed)
+
+    def do_dia_incremental(self, missing: dict) -> dict:
+        """
+        Actualiza los años de YEAR_UPDATE que ya están guardados pidiendo solo los días
+        posteriores al último guardado (menos DIA_OVERLAP), los une con los datos guardados
+        y solo vuelve a subir los años que han cambiado
+
+        :param missing: años pendientes de cada base (ver get_missing)
+        :return: años que siguen pendientes (los no guardados y los de consultas fallidas)
+        """
+        table = "DIA"
+        prefix = "raw/AEMET/{}/".format(table)
+        todo = []
+        for base, years in missing.items():
+            saved = self.bucket.partitions(prefix, base)
+            todo.extend((base, y) for y in YEAR_UPDATE if y in years and str(y) in saved)
+        if not todo:
+            return missing
+        logger.info("%s: %s años a actualizar de manera incremental", table, len(todo))
+
+        stored = {}
+        tm = ThreadMe(fix_param=table, max_thread=Scrap.UPLOAD_THREAD, stream=True)
+        for base, year, data in tm.run(self._get_stored, todo):
+            stored.setdefault(base, {})[year] = data
+
+        today = date.today()
+        jobs = []
+        for base, years in stored.items():
+            ini = today
+            for year, data in years.items():
+                fechas = [d["fecha"] for d in data if d.get("fecha")]
+                desde = date(year, 1, 1)
+                if fechas:
+                    desde = max(desde, date.fromisoformat(max(fechas)) + timedelta(days=1 - Scrap.DIA_OVERLAP))
+                ini = min(ini, desde)
+            jobs.append(Munch(id=base, ini=ini, fin=today, years=tuple(sorted(years))))
+        jobs = lpt(jobs, self.api.job_cost("DIA"))
+
+        def do_up(job, year_data):
+            if self._up_incremental(table, stored, job, year_data) is None:
+                return None
+            return job
+
+        # Solo dejan de estar pendientes los años de las consultas incrementales que terminan bien:
+        # si fallan (la consulta, su parseo o la subida) se vuelve a pedir el año completo
+        rest = {base: set(years) for base, years in missing.items()}
+        tm = ThreadMe(max_thread=Scrap.UPLOAD_THREAD, stream=True)
+        for job in tm.run(do_up, self.api.iter_dia_fechas(jobs)):
+            rest[job.id] = rest[job.id] - set(job.years)
+        return {base: years for base, years in rest.items() if years}
+
     def do_dia(self):
         """
         Recupera datos históricos diarios y los guarda en s3
         """
         logger.info("AEMET DIA")
-        for b in self.bases:
-            visto = self.get_years("DIA", b['indicativo'])
-            for y in range(Aemet.YEAR_ZERO, YEAR + 1):
-                if y not in visto:
-                    year_dias = self.api.get_dia_estacion(
-                        b['indicativo'], y, expand=True)
-                    if year_dias is not None:
-                        for year, dias in year_dias.items():
-                            visto.add(year)
-                            if dias is None:
-                                continue
-                            target = "raw/AEMET/DIA/base={}/year={}/".format(b['indicativo'], year)
-                            if len(dias) == 0:
-                                # Creamos un txt para que la entrada no se quede vacía
-                                # impidiéndonos detectar que este año ya se ha tratado
-                                target = "raw/AEMET/DIA/base={}/year={}.txt".format(b['indicativo'], year)
-                            self.bucket.up_gz(
-                                dias,
-                                target,
-                                comment=self.api.last_url
-                            )
+        missing = self.get_missing("DIA")
+        if Scrap.DIA_INCREMENTAL:
+            missing = self.do_dia_incremental(missing)
+        planner = self.api.dia_planner()
+        with self.profile("DIA") as profile:
+            tm = ThreadMe(fix_param="DIA", max_thread=Scrap.UPLOAD_THREAD, stream=True, profile=profile)
+            # Mientras se suben unos resultados, iter_dia_estacion sigue descargando los siguientes
+            jobs = planner.run(missing, self.api.iter_dia_estacion, label="DIA", cost=self.api.job_cost("DIA"))
+            for _ in tm.run(self._up_years, jobs):
+                pass
+        self.checkpoint("DIA").save()
+        self.save_costs()
 
     def do_mes(self):
         """
         Recupera datos históricos mensuales y los guarda en s3
         """
         logger.info("AEMET MES")
-        for b in self.bases:
-            visto = self.get_years("MES", b['indicativo'])
-            for year in range(Aemet.YEAR_ZERO, YEAR + 1):
-                if year in visto:
-                    continue
-                meses = self.api.get_mes_estacion(b['indicativo'], year)
-                if meses is None:
-                    continue
-                target = "raw/AEMET/MES/base={}/year={}/".format(b['indicativo'], year)
-                if len(meses) == 0:
-                    # Creamos un txt para que la entrada no se quede vacía
-                    # impidiéndonos detectar que este año ya se ha tratado
-                    target = "raw/AEMET/MES/base={}/year={}.txt".format(b['indicativo'], year)
-                self.bucket.up_gz(
-                    meses,
-                    target,
-                    comment=self.api.last_url
-                )
+        planner = self.api.mes_planner()
+        with self.profile("MES") as profile:
+            tm = ThreadMe(fix_param="MES", max_thread=Scrap.UPLOAD_THREAD, stream=True, profile=profile)
+            jobs = planner.run(self.get_missing("MES"), self.api.iter_mes_estacion, label="MES",
+                               cost=self.api.job_cost("MES"))
+            for _ in tm.run(self._up_years, jobs):
+                pass
+        self.checkpoint("MES").save()
+        self.save_costs()
+
+    def _up_prediccion(self, prov: str, datas: list):
+        """
+        Sube a s3 las predicciones de los municipios de una provincia
+        y las marca como terminadas en el manifiesto
+        """
+        elab_dias = {}
+        for data in datas:
+            if data.elaborado not in elab_dias:
+                elab_dias[data.elaborado] = []
+            dias = []
+            for dia in data.dias:
+                dia = {**{"municipio": data.municipio}, **dia}
+                dias.append(dia)
+            elab_dias[data.elaborado].extend(dias)
+
+        for elaborado, dias in elab_dias.items():
+            prov_target = "raw/AEMET/PREDICCION/elaborado={}/provincia={}/".format(elaborado, prov)
+            dias = sorted(dias, key=lambda d: (d["municipio"], d["fecha"]))
+            self.bucket.up_gz(
+                dias,
+                prov_target
+            )
+
+        # Los xml originales de cada elaboración se guardan en un único archivo por provincia
+        # (ver core.archive) en vez de en un fichero por municipio
+        archives = {}
+        for data in datas:
+            if data.elaborado not in archives:
+                archives[data.elaborado] = ArchiveWriter()
+            archives[data.elaborado].add(data.municipio, data.source.rstrip() + "\n<!-- " + data.url + " -->")
+        for elaborado, archive in archives.items():
+            content, offset = archive.close()
+            self.bucket.up_raw(
+                content,
+                "raw/AEMET/PREDICCION/elaborado={}/provincia={}/municipios.xml.gz".format(elaborado, prov),
+                "application/gzip",
+                metadata={INDEX_META: offset}
+            )
+
+        checkpoint = self.checkpoint("PREDICCION")
+        for data in datas:
+            checkpoint.done(("PREDICCION", data.municipio), [data.elaborado, data.dias])
 
     def do_prediccion(self):
         """
         Recupera datos de predicciones y los guarda en s3
+
+        Se hace con un pipeline sobre todas las provincias a la vez: los hilos de descarga
+        consultan municipios de cualquier provincia, un agregador junta los de cada provincia
+        y, en cuanto una está completa, la pasa a los hilos de subida a s3 mientras
+        se siguen descargando las demás
+
+        Con PARSE_PROCESSES el parseo de los xml sale de los hilos de descarga a una etapa
+        con un pool de procesos, para que no compita por el GIL con ellos
+
+        Si alguna etapa falla con un municipio (o su descarga supera PREDICCION_TIMEOUT), su provincia
+        no llega a completarse, igual que las que quedan pendientes al superar PREDICCION_DEADLINE
+        o cuya subida falla: al terminar el pipeline se sube lo obtenido de esas provincias
+        y se registra el error
         """
-        tm = ThreadMe(fix_param=self.api, max_thread=30)
+        checkpoint = self.checkpoint("PREDICCION")
+        expected = {}
 
-        def do_work(api, mun):
-            num_data = api.get_prediccion(mun)
-            if num_data.dias:
-                return num_data
+        def iter_muns():
+            for prov, muns in self.get_provincias().items():
+                if all(checkpoint.is_done("PREDICCION", mun) for mun in muns):
+                    logger.info("PREDICCION %s ya terminada", prov)
+                    continue
+                expected[prov] = len(muns)
+                for mun in muns:
+                    yield prov, len(muns), mun
 
-        for prov in self.api.get_provincias():
-            datas = list(tm.run(do_work, self.api.get_municipios(prov)))
-            elab_dias = {}
-            for data in datas:
-                if data.elaborado not in elab_dias:
-                    elab_dias[data.elaborado] = []
-                dias = []
-                for dia in data.dias:
-                    dia = {**{"municipio": data.municipio}, **dia}
-                    dias.append(dia)
-                elab_dias[data.elaborado].extend(dias)
-
-            for elaborado, dias in elab_dias.items():
-                prov_target = "raw/AEMET/PREDICCION/elaborado={}/provincia={}/".format(elaborado, prov)
-                dias = sorted(dias, key=lambda d: (d["municipio"], d["fecha"]))
-                self.bucket.up_gz(
-                    dias,
-                    prov_target
-                )
-
-            for data in datas:
-                target = "raw/AEMET/PREDICCION/elaborado={}/provincia={}/{}.xml".format(data.elaborado, prov,
-                                                                                        data.municipio)
-                self.bucket.up_gz(
-                    data.source.rstrip() + "\n<!-- " + data.url + " -->",
-                    target,
-                    overwrite=False
-                )
+        in_process = Scrap.PARSE_PROCESSES > 0
+
+        def do_fetch(prov, total, mun):
+            # Siempre se devuelve algo para que el agregador pueda saber cuándo está completa una provincia
+            t = time.perf_counter()
+            try:
+                num_data = self.api.get_prediccion(mun, parse=not in_process)
+            except Exception as e:
+                logger.critical("PREDICCION " + str(mun) + " > " + str(e), exc_info=True)
+                num_data = None
+            if num_data is not None and self.api.costs is not None:
+                self.api.costs.observe("PREDICCION", prov, time.perf_counter() - t)
+            if num_data and (num_data.dias or "content" in num_data):
+                return prov, total, num_data, False
+            return prov, total, None, False
+
+        # Municipios agregados de cada provincia, que se conservan hasta que termina su subida
+        pending = {}
+        lock = Lock()
+
+        def do_aggregate(prov, total, num_data, parsed):
+            # Etapa de un solo hilo que nunca se abandona: solo comparte pending con el bucle de subidas
+            if parsed:
+                try:
+                    self.api.set_prediccion(num_data)
+                except Exception as e:
+                    logger.critical("PREDICCION " + str(num_data.municipio) + " > " + str(e), exc_info=True)
+            if num_data is not None and not num_data.dias:
+                num_data = None
+            with lock:
+                count, _, datas = pending.get(prov, (0, total, []))
+                if num_data is not None:
+                    datas.append(num_data)
+                count = count + 1
+                pending[prov] = (count, total, datas)
+            if count < total:
+                return None
+            return prov, datas
+
+        def do_upload(prov, datas):
+            self._up_prediccion(prov, datas)
+            return prov
+
+        stages = [(do_fetch, Scrap.MAX_THREAD)]
+        if in_process:
+            stages.append((_parse_prediccion, Scrap.PARSE_PROCESSES, True))
+        stages.append((do_aggregate, 1))
+        stages.append((do_upload, Scrap.UPLOAD_THREAD))
+        errors = []
+        with self.profile("PREDICCION") as profile:
+            # Solo se abandonan descargas: el agregador y las subidas no pueden quedarse a medias
+            timeout = [Scrap.PREDICCION_TIMEOUT]
+            for prov in pipeline(iter_muns(), *stages, profile=profile, timeout=timeout,
+                                 deadline=Scrap.PREDICCION_DEADLINE, errors=errors):
+                logger.info("PREDICCION %s subida", prov)
+                expected.pop(prov, None)
+                with lock:
+                    pending.pop(prov, None)
+        if errors:
+            by_stage = {}
+            for stage, _, e in errors:
+                key = "{} {}".format(stage, type(e).__name__)
+                by_stage[key] = by_stage.get(key, 0) + 1
+            logger.critical("PREDICCION %s tareas fallidas: %s", len(errors), by_stage)
+        for prov, total in expected.items():
+            # Los municipios que han fallado en alguna etapa no han llegado al agregador
+            count, _, datas = pending.get(prov, (0, total, []))
+            logger.critical("PREDICCION %s no subida completa (%s de %s municipios agregados)", prov, count, total)
+            if datas:
+                try:
+                    self._up_prediccion(prov, datas)
+                except Exception as e:
+                    logger.critical("PREDICCION " + str(prov) + " > " + str(e), exc_info=True)
+        checkpoint.save()
+        self.save_costs()
 
     def need_update(self) -> list:
         """
@@ -151,21 +517,158 @@ class Scrap:
         return [i.rsplit("/", 1)[0] for i in self.bucket.uploaded if i.endswith("/data.json.gz")]
 
 
+class AsyncScrap(Scrap):
+    """
+    Igual que Scrap pero consultando la Aemet con asyncio en un único hilo
+
+    Atributos:
+        CONCURRENCY: número máximo de peticiones en vuelo
+    """
+    CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY", 200))
+
+    def __init__(self, bucket: Bucket, shard: Shard = None, run: str = None):
+        super().__init__(bucket, shard=shard, run=run)
+        self.aapi = AsyncAemet(concurrency=AsyncScrap.CONCURRENCY)
+        # Ambos clientes comparten cuota y métricas
+        self.aapi.limiter = self.api.limiter
+        self.aapi.metrics = self.api.metrics
+        self.aapi.costs = self.api.costs
+
+    async def _do_jobs(self, table: str, planner, fetch, url):
+        """
+        Ejecuta concurrentemente las consultas planificadas del histórico de una tabla,
+        subiendo cada resultado según llega y dividiendo las consultas que fallen
+
+        :param table: tabla del histórico (DIA o MES)
+        :param planner: planificador de consultas
+        :param fetch: corrutina que recibe una consulta y devuelve sus datos por año
+        :param url: plantilla de la url de la consulta (para el comentario de los ficheros)
+        """
+        loop = asyncio.get_running_loop()
+
+        async def do_job(job):
+            return job, await fetch(job)
+
+        # El semáforo de AsyncAemet deja pasar las consultas en el orden en que se crean
+        cost = self.aapi.job_cost(table)
+        jobs = lpt(planner.plan(self.get_missing(table)), cost)
+        logger.info("%s: %s consultas previstas", table, len(jobs))
+        while jobs:
+            failed = []
+            for f in asyncio.as_completed([do_job(j) for j in jobs]):
+                job, data = await f
+                if data is None:
+                    failed.extend(planner.split(job))
+                    continue
+                job.url = url.format(id=job.id, ini=job.ini, fin=job.fin)
+                await loop.run_in_executor(None, self._up_years, table, job, data)
+            jobs = lpt(failed, cost)
+        self.checkpoint(table).save()
+
+    async def ado_dia(self):
+        """
+        Recupera datos históricos diarios y los guarda en s3
+        """
+        logger.info("AEMET DIA")
+
+        async def fetch(job):
+            return await self.aapi.get_dia_estacion(job.id, job.ini, fin=job.fin)
+
+        async with self.aapi:
+            await self._do_jobs("DIA", self.aapi.dia_planner(), fetch, self.aapi.url.estacion.diario)
+
+    async def ado_mes(self):
+        """
+        Recupera datos históricos mensuales y los guarda en s3
+        """
+        logger.info("AEMET MES")
+
+        async def fetch(job):
+            return await self.aapi.get_mes_estacion(job.id, job.ini, fin=job.fin)
+
+        async with self.aapi:
+            await self._do_jobs("MES", self.aapi.mes_planner(), fetch, self.aapi.url.estacion.mensual)
+
+    async def _do_prediccion_prov(self, prov: str, muns: tuple):
+        checkpoint = self.checkpoint("PREDICCION")
+        if all(checkpoint.is_done("PREDICCION", mun) for mun in muns):
+            logger.info("PREDICCION %s ya terminada", prov)
+            return
+        datas = await asyncio.gather(*(self.aapi.get_prediccion(mun) for mun in muns))
+        datas = [d for d in datas if d is not None and d.dias]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._up_prediccion, prov, datas)
+
+    async def ado_prediccion(self):
+        """
+        Recupera datos de predicciones y los guarda en s3
+        """
+        async with self.aapi:
+            await asyncio.gather(*(self._do_prediccion_prov(prov, muns)
+                                   for prov, muns in self.get_provincias().items()))
+        self.checkpoint("PREDICCION").save()
+
+    def do_dia(self):
+        asyncio.run(self.ado_dia())
+
+    def do_mes(self):
+        asyncio.run(self.ado_mes())
+
+    def do_prediccion(self):
+        asyncio.run(self.ado_prediccion())
+
+
 if __name__ == "__main__":
     arg = mkArg(
         "Scraping de la AEMET",
         mes="Hace scraping de los datos mensuales",
         dia="Hace scraping de los datos diarios",
         pre="Hace scraping de los datos de predicción",
-        glue="Ejecutar Glue"
+        glue="Ejecutar Glue",
+        asyncio="Consulta la Aemet con asyncio en vez de con hilos",
+        run=dict(metavar="id", help="Identificador de la ejecución (por defecto RUN_ID o la fecha y hora). "
+                                    "Repitiéndolo se retoma una ejecución interrumpida"),
+        shard=dict(metavar="i/n", help="Hace solo la parte i de n del trabajo y guarda su lista need_update "
+                                       "para que la una --merge"),
+        merge=dict(metavar="n", type=int, help="Une las listas need_update de los n shards de --run "
+                                               "y, si se indica --glue, ejecuta Glue una única vez")
     )
-    sc = Scrap(Bucket(os.environ['S3_TARGET']))
+    if os.environ.get("LOCAL_BUCKET"):
+        # Ejecución sin s3 (por ejemplo junto a AEMET_REPLAY, ver core.replay)
+        bucket = LocalBucket(os.environ["LOCAL_BUCKET"])
+    else:
+        bucket = Bucket(os.environ['S3_TARGET'])
+    run = arg.run or os.environ.get("RUN_ID")
+    if (arg.shard or arg.merge) and not run:
+        sys.exit("--shard y --merge necesitan un --run (o RUN_ID) común a todas las partes")
+    if arg.merge:
+        need_update = Shard.merge(bucket, run, arg.merge)
+        logger.info("%s shards: %s ficheros nuevos o modificados", arg.merge, len(need_update))
+        if arg.glue and need_update:
+            glue = Glue(os.environ['GLUE_TARGET'])
+            glue.start()
+        sys.exit()
+    shard = Shard.parse(arg.shard)
+    sc = (AsyncScrap if arg.asyncio else Scrap)(bucket, shard=shard, run=run)
     if arg.dia:
         sc.do_dia()
     if arg.mes:
         sc.do_mes()
     if arg.pre:
         sc.do_prediccion()
-    if arg.glue and sc.need_update():
+    logger.info("pool de conexiones: %s", sc.api.pool_stats())
+    if sc.api.key_endpoints:
+        logger.info("uso de las api keys: %s", sc.api.key_stats())
+    if sc.api.cache:
+        logger.info("caché http: %s", sc.api.cache.stats())
+    logger.info("métricas: %s", sc.api.metrics.to_json())
+    sc.api.metrics.dump(
+        json_file=os.environ.get("METRICS_JSON", "metrics.json"),
+        prom_file=os.environ.get("METRICS_PROM", "metrics.prom")
+    )
+    if shard is not None:
+        # Glue se lanza una sola vez desde --merge cuando terminan todos los shards
+        shard.save(bucket, run, sc.need_update())
+    elif arg.glue and sc.need_update():
         glue = Glue(os.environ['GLUE_TARGET'])
         glue.start()